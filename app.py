@@ -1,12 +1,21 @@
+import atexit
 import os
-from flask import Flask, render_template, request, flash, redirect, url_for, session, g, jsonify
+import time
+import click
+from flask import Flask, render_template, request, flash, redirect, url_for, session, g, jsonify, abort
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_bcrypt import Bcrypt
 from functools import wraps
 from dotenv import load_dotenv
 from flask_migrate import Migrate
-from fetch import fetch_all_data
-from models import db, connect_db, User, Comment, Person, Film, Starship, Vehicle, Species, Planet, CommentVote, search_elements
+from flask.cli import AppGroup
+from sqlalchemy.orm import joinedload, selectinload
+from fetch import sync_data, data_source, ingest_lock, IngestLocked, StageStats, CONCURRENCY, BATCH_SIZE
+from seed import export_seed, load_seed
+from pagination import keyset_page, paginate, BadCursor
+from votes import cast_vote, record_vote, reconcile_votes, vote_buffer
+from search import run_search, search_index, rebuild_search_index, search_cache, search_flights
+from models import db, connect_db, User, Comment, Person, Film, Starship, Vehicle, Species, Planet, full_text_search, load_comment_targets
 from forms import SignUpForm, LoginForm, EditUserForm, AddCommentForm
 
 CURR_USER_KEY = "curr_user"
@@ -22,14 +31,26 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+# 'index' answers /search from the in-memory typeahead index, 'db' queries the
+# tables and 'trigram' runs a typo-tolerant pg_trgm search on PostgreSQL
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'index')
+# Let browsers download the search index and run typeahead locally
+app.config['SEARCH_CLIENT_INDEX'] = os.environ.get('SEARCH_CLIENT_INDEX', '1') == '1'
+# Buffer vote counter updates and write them in batches; the vote rows
+# themselves are always written at once
+app.config['VOTE_WRITE_BEHIND'] = os.environ.get('VOTE_WRITE_BEHIND', '0') == '1'
 
 toolbar = DebugToolbarExtension(app)
 connect_db(app)
 
 with app.app_context():
-    # db.drop_all()
     db.create_all()
-    # fetch_all_data()
+    if app.config['SEARCH_BACKEND'] == 'index':
+        rebuild_search_index()
+
+if app.config['VOTE_WRITE_BEHIND']:
+    vote_buffer.start(app)
+    atexit.register(vote_buffer.stop)
 
 
 def login_required(f):
@@ -61,7 +82,36 @@ def home():
 def search():
     search_query = request.args.get('query', '')
 
-    res = search_elements(search_query)
+    res = run_search(search_query, app.config['SEARCH_BACKEND'])
+
+    return jsonify(res)
+
+
+@app.route('/search/index.json', methods=['GET'])
+def search_index_json():
+    """Every searchable name and title, for typeahead in the browser.
+
+    Browsers revalidate it on each use and get a 304 until the data changes."""
+    body, etag = search_index().document()
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.cache_control.public = True
+    return response.make_conditional(request)
+
+
+@app.route('/search/stats', methods=['GET'])
+def search_stats():
+    """Counters of the /search result cache and request coalescing"""
+    return jsonify(cache=search_cache.stats(), single_flight=search_flights.stats())
+
+
+@app.route('/search/text', methods=['GET'])
+def text_search():
+    """Full-text search over names and descriptions, with snippets"""
+    search_query = request.args.get('query', '')
+
+    res = full_text_search(search_query)
 
     return jsonify(res)
 
@@ -139,26 +189,16 @@ def user_profile(user_id):
         return redirect(url_for('user_profile', user_id=g.user.id))
 
     user = User.query.get_or_404(user_id)
-    comments_with_associations = []
-
-    for comment in user.comments:
-        associated_element = None
-        if comment.person_id:
-            associated_element = Person.query.get(comment.person_id)
-        elif comment.film_id:
-            associated_element = Film.query.get(comment.film_id)
-        elif comment.starship_id:
-            associated_element = Starship.query.get(comment.starship_id)
-        elif comment.vehicle_id:
-            associated_element = Vehicle.query.get(comment.vehicle_id)
-        elif comment.species_id:
-            associated_element = Species.query.get(comment.species_id)
-        elif comment.planet_id:
-            associated_element = Planet.query.get(comment.planet_id)
-
-        comments_with_associations.append((comment, associated_element))
+    after = request.args.get('after')
+    try:
+        comments, next_cursor = paginate(db.select(Comment).where(Comment.user_id == user.id), Comment,
+                                         Comment.upvotes, descending=True, after=after)
+    except BadCursor:
+        abort(400)
+    comments_with_associations = list(zip(comments, load_comment_targets(comments)))
 
-    return render_template('/users/profile.html', user=user, comments_with_associations=comments_with_associations)
+    return render_template('/users/profile.html', user=user, comments_with_associations=comments_with_associations,
+                           after=after, next_cursor=next_cursor)
 
 
 
@@ -215,148 +255,185 @@ def delete_user(user_id):
 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 
 
+def list_page(model):
+    """The page of a list route asked for by ?sort=, ?order= and ?after="""
+    try:
+        return keyset_page(model, sort=request.args.get('sort'), order=request.args.get('order', 'asc'),
+                           after=request.args.get('after'))
+    except BadCursor:
+        abort(400)
+
+
 @app.route('/characters', methods=['GET'])
 def list_characters():
     """Load list of characters"""
-    people = Person.query.all()
-    return render_template('swapi/people_list.html', people=people)
+    page = list_page(Person)
+    return render_template('swapi/people_list.html', people=page.items, page=page)
 
 @app.route('/characters/<int:person_id>', methods=['GET', 'POST'])
 def person_detail(person_id):
     """Load details of one specific person"""
-    person = Person.query.get_or_404(person_id)
+    person = Person.query.options(
+        joinedload(Person.homeworld),
+        selectinload(Person.films),
+        selectinload(Person.species),
+        selectinload(Person.starships),
+        selectinload(Person.vehicles),
+        selectinload(Person.comments).joinedload(Comment.user),
+    ).get_or_404(person_id)
     form = AddCommentForm()
 
     if form.validate_on_submit():
-        comment = Comment(
+        comment = Comment.about(
+            person,
             text=form.text.data,
-            user_id=g.user.id,
-            person_id=person.id
+            user_id=g.user.id
         )
         db.session.add(comment)
         db.session.commit()
         return redirect(url_for('person_detail', person_id=person.id))
-    comments = Comment.query.filter_by(person_id=person.id).all()
+    comments = person.comments
     return render_template('swapi/person_detail.html', person=person, form=form, comments=comments)
 
 @app.route('/films', methods=['GET'])
 def list_films():
     """Load list of films"""
-    films = Film.query.all()
-    return render_template('swapi/films_list.html', films=films)
+    page = list_page(Film)
+    return render_template('swapi/films_list.html', films=page.items, page=page)
 
 @app.route('/films/<int:film_id>', methods=['GET', 'POST'])
 def film_detail(film_id):
     """Load details of a film"""
-    film = Film.query.get_or_404(film_id)
+    film = Film.query.options(
+        selectinload(Film.characters),
+        selectinload(Film.planets),
+        selectinload(Film.comments).joinedload(Comment.user),
+    ).get_or_404(film_id)
     form = AddCommentForm()
 
     if form.validate_on_submit():
-        comment = Comment(
+        comment = Comment.about(
+            film,
             text=form.text.data,
-            user_id=g.user.id,
-            film_id=film.id
+            user_id=g.user.id
         )
         db.session.add(comment)
         db.session.commit()
         return redirect(url_for('film_detail', film_id=film.id))
-    comments = Comment.query.filter_by(film_id=film.id).all()
+    comments = film.comments
     return render_template('swapi/film_detail.html', film=film, form=form, comments=comments)
 
 @app.route('/starships', methods=['GET'])
 def list_starships():
     """Load list of starships"""
-    starships = Starship.query.all()
-    return render_template('/swapi/starships_list.html', starships=starships)
+    page = list_page(Starship)
+    return render_template('/swapi/starships_list.html', starships=page.items, page=page)
 
 @app.route('/starships/<int:starship_id>', methods=['GET', 'POST'])
 def starship_detail(starship_id):
     """Load details of a starship"""
     form = AddCommentForm()
 
-    starship = Starship.query.get_or_404(starship_id)
+    starship = Starship.query.options(
+        selectinload(Starship.pilots),
+        selectinload(Starship.films),
+        selectinload(Starship.comments).joinedload(Comment.user),
+    ).get_or_404(starship_id)
     if form.validate_on_submit():
-        comment = Comment(
+        comment = Comment.about(
+            starship,
             text=form.text.data,
-            user_id=g.user.id,
-            starship_id=starship.id
+            user_id=g.user.id
         )
         db.session.add(comment)
         db.session.commit()
         return redirect(url_for('starship_detail', starship_id=starship.id))
-    comments = Comment.query.filter_by(starship_id=starship.id).all()
+    comments = starship.comments
     return render_template('/swapi/starship_detail.html', starship=starship, form=form, comments=comments)
 
 @app.route('/vehicles', methods=['GET'])
 def list_vehicles():
     """Load list of vehicles"""
-    vehicles = Vehicle.query.all()
-    return render_template('/swapi/vehicles_list.html', vehicles=vehicles)
+    page = list_page(Vehicle)
+    return render_template('/swapi/vehicles_list.html', vehicles=page.items, page=page)
 
 @app.route('/vehicles/<int:vehicle_id>', methods=['GET', 'POST'])
 def vehicle_detail(vehicle_id):
     """Load details of a vehicle"""
     form = AddCommentForm()
 
-    vehicle = Vehicle.query.get_or_404(vehicle_id)
+    vehicle = Vehicle.query.options(
+        selectinload(Vehicle.pilots),
+        selectinload(Vehicle.films),
+        selectinload(Vehicle.comments).joinedload(Comment.user),
+    ).get_or_404(vehicle_id)
     if form.validate_on_submit():
-        comment = Comment(
+        comment = Comment.about(
+            vehicle,
             text=form.text.data,
-            user_id=g.user.id,
-            vehicle_id=vehicle.id
+            user_id=g.user.id
         )
         db.session.add(comment)
         db.session.commit()
         return redirect(url_for('vehicle_detail', vehicle_id=vehicle.id))
-    comments = Comment.query.filter_by(vehicle_id=vehicle.id).all()
+    comments = vehicle.comments
     return render_template('/swapi/vehicle_detail.html', vehicle=vehicle, form=form, comments=comments)
 
 @app.route('/species', methods=['GET'])
 def list_species():
     """Load list of species"""
-    species = Species.query.all()
-    return render_template('/swapi/species_list.html', species=species)
+    page = list_page(Species)
+    return render_template('/swapi/species_list.html', species=page.items, page=page)
 
 @app.route('/species/<int:species_id>', methods=['GET', 'POST'])
 def species_detail(species_id):
     """Load details of a species"""
     form = AddCommentForm()
 
-    species = Species.query.get_or_404(species_id)
+    species = Species.query.options(
+        joinedload(Species.homeworld),
+        selectinload(Species.people),
+        selectinload(Species.films),
+        selectinload(Species.comments).joinedload(Comment.user),
+    ).get_or_404(species_id)
     if form.validate_on_submit():
-        comment = Comment(
+        comment = Comment.about(
+            species,
             text=form.text.data,
-            user_id=g.user.id,
-            species_id=species.id
+            user_id=g.user.id
         )
         db.session.add(comment)
         db.session.commit()
         return redirect(url_for('species_detail', species_id=species.id))
-    comments = Comment.query.filter_by(species_id=species.id).all()
+    comments = species.comments
     return render_template('/swapi/species_detail.html', species=species, form=form, comments=comments)
 
 @app.route('/planets', methods=['GET'])
 def list_planets():
     """Load list of planets"""
-    planets = Planet.query.all()
-    return render_template('/swapi/planets_list.html', planets=planets)
+    page = list_page(Planet)
+    return render_template('/swapi/planets_list.html', planets=page.items, page=page)
 
 @app.route('/planets/<int:planet_id>', methods=['GET', 'POST'])
 def planet_detail(planet_id):
     """Load a details of a planet"""
     form = AddCommentForm()
 
-    planet = Planet.query.get_or_404(planet_id)
+    planet = Planet.query.options(
+        selectinload(Planet.residents),
+        selectinload(Planet.films),
+        selectinload(Planet.comments).joinedload(Comment.user),
+    ).get_or_404(planet_id)
     if form.validate_on_submit():
-        comment = Comment(
+        comment = Comment.about(
+            planet,
             text=form.text.data,
-            user_id=g.user.id,
-            planet_id=planet.id
+            user_id=g.user.id
         )
         db.session.add(comment)
         db.session.commit()
         return redirect(url_for('planet_detail', planet_id=planet.id))
-    comments = Comment.query.filter_by(planet_id=planet.id).all()
+    comments = planet.comments
     return render_template('/swapi/planet_detail.html', planet=planet, form=form, comments=comments)
 
 
@@ -376,40 +453,22 @@ def vote_comment(comment_id):
         flash('You cannot vote on your own comment.', 'warning')
         return redirect(request.referrer)
 
-    existing_vote = CommentVote.query.filter_by(comment_id=comment.id, user_id=g.user.id).first()
-
-    if existing_vote:
-        if (vote_type == 'up' and existing_vote.vote) or (vote_type == 'down' and not existing_vote.vote):
-            db.session.delete(existing_vote)
-            if vote_type == 'up':
-                comment.upvotes -= 1
-            else:
-                comment.downvotes -= 1
-
-        else:
-            existing_vote.vote = vote_type =='up'
-            if vote_type == 'up':
-                comment.upvotes += 1
-                comment.downvotes -= 1
-            else:
-                comment.upvotes -= 1
-                comment.downvotes += 1
+    if app.config['VOTE_WRITE_BEHIND']:
+        delta = record_vote(comment.id, g.user.id, vote_type == 'up')
+        db.session.commit()
+        vote_buffer.add(comment.id, delta)
     else:
-        new_vote = CommentVote(
-            comment_id=comment.id,
-            user_id=g.user.id,
-            vote=vote_type == 'up'
-        )
-        db.session.add(new_vote)
-        if vote_type == 'up':
-            comment.upvotes += 1
-        else:
-            comment.downvotes += 1
-
-    db.session.commit()
+        cast_vote(comment.id, g.user.id, vote_type == 'up')
+        db.session.commit()
     return redirect(request.referrer)
 
 
+@app.route('/votes/stats', methods=['GET'])
+def vote_stats():
+    """Counters of the write-behind vote buffer"""
+    return jsonify(write_behind=app.config['VOTE_WRITE_BEHIND'], buffer=vote_buffer.stats())
+
+
 @app.route('/comment/<int:comment_id>/delete', methods=['POST'])
 @login_required
 def delete_comment(comment_id):
@@ -428,5 +487,96 @@ def delete_comment(comment_id):
     return redirect(url_for('user_profile', user_id=g.user.id))
 
 
+# %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#            CLI commands
+# %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+
+swapi_cli = AppGroup('swapi', help='Manage the SWAPI data.')
+
+
+@swapi_cli.command('export-seed')
+@click.argument('path')
+def export_seed_command(path):
+    """Export the SWAPI tables to a seed pack at PATH"""
+    start = time.perf_counter()
+    counts = export_seed(path)
+    click.echo(f'Exported {sum(counts.values())} rows from {len(counts)} tables '
+               f'to {path} in {time.perf_counter() - start:.2f}s')
+
+
+@swapi_cli.command('load-seed')
+@click.argument('path')
+def load_seed_command(path):
+    """Load the SWAPI tables from the seed pack at PATH"""
+    start = time.perf_counter()
+    try:
+        counts = load_seed(path)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    rebuild_search_index()
+    click.echo(f'Loaded {sum(counts.values())} rows into {len(counts)} tables '
+               f'in {time.perf_counter() - start:.2f}s')
+
+
+@swapi_cli.command('sync')
+@click.option('--source', default=None, help='SWAPI base url or snapshot archive (default: SWAPI_SOURCE).')
+@click.option('--concurrency', default=CONCURRENCY, show_default=True, help='Pages fetched at once.')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Rows written per transaction.')
+@click.option('--restart', is_flag=True, help='Ignore checkpoints left by an interrupted sync.')
+def sync_command(source, concurrency, batch_size, restart):
+    """Fetch SWAPI and apply whatever changed since the last sync.
+
+    Resumes from the last checkpoint if a previous sync was interrupted."""
+    def progress(resource, page, total):
+        click.echo(f'  {resource}: page {page}/{total}')
+
+    stages = StageStats()
+    source = data_source(source, concurrency)
+    start = time.perf_counter()
+    try:
+        with ingest_lock():
+            counts = sync_data(source=source, concurrency=concurrency, batch_size=batch_size,
+                               stages=stages, resume=not restart, progress=progress)
+    except IngestLocked as e:
+        raise click.ClickException(str(e))
+    finally:
+        source.close()
+    rebuild_search_index()
+
+    for name, (items, seconds, rate) in stages.summary().items():
+        click.echo(f'{name:>10}: {items} items in {seconds:.2f}s ({rate:.0f}/s)')
+    click.echo(', '.join(f'{key} {value}' for key, value in counts.items()))
+    scheduler = getattr(source, 'scheduler', None)
+    if scheduler:
+        click.echo('http: ' + ', '.join(f'{key} {value}' for key, value in scheduler.counters.items()))
+    click.echo(f'Synced in {time.perf_counter() - start:.2f}s')
+
+
+app.cli.add_command(swapi_cli)
+
+
+votes_cli = AppGroup('votes', help='Manage comment votes.')
+
+
+@votes_cli.command('reconcile')
+@click.option('--full', is_flag=True, help='Check every comment, not just those voted on since the last run.')
+@click.option('--dry-run', is_flag=True, help='Report drift without repairing it.')
+def reconcile_command(full, dry_run):
+    """Recompute comment vote counters from the recorded votes."""
+    start = time.perf_counter()
+    drift = reconcile_votes(full=full, repair=not dry_run)
+
+    for comment_id, up, down in drift[:20]:
+        click.echo(f'  comment {comment_id}: upvotes {up:+d}, downvotes {down:+d}')
+    if len(drift) > 20:
+        click.echo(f'  ... and {len(drift) - 20} more')
+    action = 'Found' if dry_run else 'Repaired'
+    click.echo(f'{action} drift on {len(drift)} comments in {time.perf_counter() - start:.2f}s')
+
+
+app.cli.add_command(votes_cli)
+
+
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -1,310 +1,1053 @@
-import requests 
-
-from models import db, Person, Film, Starship, Vehicle, Species, Planet
-
-BASE_URL = "https://swapi.dev/api/"
-
-
-def fetch_and_store_people():
-    """Get json response of API data for People"""
-    url = f'{BASE_URL}people/'
-
-    while url:
-        res = requests.get(url)
-        data = res.json()
-
-        for item in data['results']:
-            homeworld_id = None
-            if item['homeworld']:
-                homeworld_id = int(item['homeworld'].split('/')[-2])
-
-            person = Person(
-                name=item['name'],
-                birth_year=item['birth_year'],
-                eye_color=item['eye_color'],
-                gender=item['gender'],
-                hair_color=item['hair_color'],
-                height=item['height'],
-                mass=item['mass'],
-                skin_color=item['skin_color'],
-                homeworld_id=homeworld_id,
-            )
-            db.session.add(person)
-            db.session.commit()
-
-            for film_url in item['films']:
-                film_id = int(film_url.split('/')[-2])
-                film = Film.query.get(film_id)
-                if film:
-                    person.films.append(film)
-
-            for species_url in item['species']:
-                species_id = int(species_url.split('/')[-2])
-                species = Species.query.get(species_id)
-                if species:
-                    person.species.append(species)
-
-            for starship_url in item['starships']:
-                starship_id = int(starship_url.split('/')[-2])
-                starship = Starship.query.get(starship_id)
-                if starship:
-                    person.starships.append(starship)
-
-            for vehicle_url in item['vehicles']:
-                vehicle_id = int(vehicle_url.split('/')[-2])
-                vehicle = Vehicle.query.get(vehicle_id)
-                if vehicle:
-                    person.vehicles.append(vehicle)
-
-
-        db.session.commit()
-
-        url = data['next']
-
-
-
-def fetch_and_store_films():
-    """Get json response of API data for Films"""
-    url = f'{BASE_URL}films/'
-
-    while url:
-        res = requests.get(url)
-        data = res.json()
-
-        for item in data['results']:
-            film = Film(
-                title=item['title'],
-                episode_id=item['episode_id'],
-                opening_crawl=item['opening_crawl'],
-                director=item['director'],
-                producer=item['producer'],
-                release_date=item['release_date'],
-            )
-            db.session.add(film)
-            db.session.commit()
-
-            for species_url in item['species']:
-                species_id = int(species_url.split('/')[-2])
-                species = Species.query.get(species_id)
-                if species:
-                    film.species.append(species)
-
-            for starship_url in item['starships']:
-                starship_id = int(starship_url.split('/')[-2])
-                starship = Starship.query.get(starship_id)
-                if starship:
-                    film.starships.append(starship)
-
-            for vehicle_url in item['vehicles']:
-                vehicle_id = int(vehicle_url.split('/')[-2])
-                vehicle = Vehicle.query.get(vehicle_id)
-                if vehicle:
-                    film.vehicles.append(vehicle)
-            
-            for person_url in item['characters']:
-                person_id = int(person_url.split('/')[-2])
-                person = Person.query.get(person_id)
-                if person:
-                    film.characters.append(person)
-
-            for planet_url in item['planets']:
-                planet_id = int(planet_url.split('/')[-2])
-                planet = Planet.query.get(planet_id)
-                if planet:
-                    film.planets.append(planet)
-
-            db.session.commit()
-
-        url= data['next']
-
-
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import zipfile
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
 
-def fetch_and_store_starships():
-    """Get json response of API data for Starships"""
-    url = f'{BASE_URL}starships/'
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import (db, Person, Film, Starship, Vehicle, Species, Planet, people_films, species_people,
+                    people_starships, people_vehicles, films_species, films_starships, films_vehicles,
+                    films_planets, SwapiRecord, SwapiPage, SyncCheckpoint, DataVersion, SEARCH_COLUMNS, SEARCH_DOCUMENTS,
+                    search_vector_expression)
 
-    while url:
-        res = requests.get(url)
-        data = res.json()
-
-
-        for item in data['results']:
-            starship = Starship(
-                name=item['name'],
-                model=item['model'],
-                starship_class=item['starship_class'],
-                manufacturer=item['manufacturer'],
-                cost_in_credits=item['cost_in_credits'],
-                length=item['length'],
-                crew=item['crew'],
-                passengers=item['passengers'],
-                max_atmosphering_speed=item['max_atmosphering_speed'],
-                hyperdrive_rating=item['hyperdrive_rating'],
-                MGLT=item['MGLT'],
-                cargo_capacity=item['cargo_capacity'],
-                consumables=item['consumables'],
-            )
-            db.session.add(starship)
-            db.session.commit()
-
-            for film_url in item['films']:
-                film_id = int(film_url.split('/')[-2])
-                film = Film.query.get(film_id)
-                if film:
-                    starship.films.append(film)
-
-            for person_url in item['pilots']:
-                person_id = int(person_url.split('/')[-2])
-                pilot = Person.query.get(person_id)
-                if pilot:
-                    starship.pilots.append(pilot)
-            
-            db.session.commit()
-
-        url= data['next']
-
-
-
-def fetch_and_store_vehicles():
-    """Get json response of API data for Vehicles"""
-    url = f'{BASE_URL}vehicles/'
-
-    while url:
-        res = requests.get(url)
-        data = res.json()
-
-        for item in data['results']:
-            vehicle = Vehicle(
-                name=item['name'],
-                model=item['model'],
-                vehicle_class=item['vehicle_class'],
-                manufacturer=item['manufacturer'],
-                length=item['length'],
-                cost_in_credits=item['cost_in_credits'],
-                crew=item['crew'],
-                passengers=item['passengers'],
-                max_atmosphering_speed=item['max_atmosphering_speed'],
-                cargo_capacity=item['cargo_capacity'],
-                consumables=item['consumables'],
-            )
-            db.session.add(vehicle)
-            db.session.commit()
+log = logging.getLogger(__name__)
 
-            for film_url in item['films']:
-                film_id = int(film_url.split('/')[-2])
-                film = Film.query.get(film_id)
-                if film:
-                    vehicle.films.append(film)
-
-            for person_url in item['pilots']:
-                person_id = int(person_url.split('/')[-2])
-                pilot = Person.query.get(person_id)
-                if pilot:
-                    vehicle.pilots.append(pilot)
-            
+BASE_URL = os.environ.get('SWAPI_BASE_URL', "https://swapi.dev/api/")
+
+# Where fetch_all_data and sync_data read from by default: a SWAPI base url or
+# the path of a snapshot archive made by record_snapshot
+SOURCE = os.environ.get('SWAPI_SOURCE', BASE_URL)
+
+# Upper bound on SWAPI requests in flight during a concurrent fetch
+CONCURRENCY = int(os.environ.get('SWAPI_CONCURRENCY', 8))
+
+# Seconds before a single SWAPI request is given up on, and how many times a
+# failed or throttled request is retried
+TIMEOUT = float(os.environ.get('SWAPI_TIMEOUT', 10))
+RETRIES = int(os.environ.get('SWAPI_RETRIES', 5))
+
+# Longest Retry-After, in seconds, a retry waits for
+MAX_RETRY_AFTER = float(os.environ.get('SWAPI_MAX_RETRY_AFTER', 60))
+
+# Rows written per insert batch / transaction when storing
+BATCH_SIZE = int(os.environ.get('SWAPI_BATCH_SIZE', 500))
+
+# Resources in the order they are stored
+RESOURCES = ['planets', 'people', 'films', 'species', 'starships', 'vehicles']
+
+# Key for the PostgreSQL advisory lock held while a sync runs
+INGEST_LOCK_KEY = 0x53574150
+
+# One list page out of `total`; `results` is None when the page was not
+# fetched, either because the server answered 304 Not Modified or because it
+# was skipped
+Page = namedtuple('Page', 'number results etag total')
+
+
+def make_session(concurrency=CONCURRENCY):
+    """Create a keep-alive session with a connection pool big enough for
+    `concurrency` worker threads"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_page(session, url, etag=None, scheduler=None):
+    """Get one page of API data as json.
+
+    Returns (data, etag).  When `etag` is given the request is conditional,
+    and data is None if the page has not changed since.  Requests go through
+    `scheduler` when one is given."""
+    headers = {'If-None-Match': etag} if etag else {}
+    if scheduler:
+        res = scheduler.get(session, url, headers)
+    else:
+        res = session.get(url, headers=headers, timeout=TIMEOUT)
+    if res.status_code == 304:
+        return None, etag
+
+    res.raise_for_status()
+    return res.json(), res.headers.get('ETag')
+
+
+def page_count(data):
+    """Number of pages in a resource, worked out from its first page"""
+    if not data['results']:
+        return 1
+    return -(-data['count'] // len(data['results']))
+
+
+def swapi_id(url):
+    """Pull the numeric id out of a SWAPI resource url"""
+    return int(url.split('/')[-2])
+
+
+def page_url(base_url, resource, number):
+    """Url of one list page of a resource"""
+    return f'{base_url}{resource}/' if number == 1 else f'{base_url}{resource}/?page={number}'
+
+
+class FetchScheduler:
+    """Runs SWAPI requests with timeouts, retries and an adaptive limit on
+    how many are in flight.
+
+    Every request gets `timeout` seconds.  Connection errors, timeouts, 429s
+    and 5xx responses are retried up to `retries` times after a jittered
+    exponential backoff, or after the Retry-After the server asked for if
+    that is longer, up to `max_retry_after` seconds.  A Retry-After that
+    cannot be parsed is ignored.
+
+    The in-flight limit is adapted AIMD style between 1 and
+    `max_concurrency`: it is halved on every 429, error or response slower
+    than `slow_after` seconds, and grows by one after `limit` fast responses
+    in a row.
+
+    `counters` keeps totals of requests, retries, throttles, errors and
+    bytes fetched."""
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_concurrency=CONCURRENCY, timeout=TIMEOUT, retries=RETRIES, backoff=0.5,
+                 max_backoff=30.0, slow_after=None, max_retry_after=MAX_RETRY_AFTER):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.slow_after = slow_after if slow_after is not None else timeout / 2
+        self.in_flight = 0
+        self.streak = 0
+        self.condition = threading.Condition()
+        self.counters = {'requests': 0, 'retries': 0, 'throttled': 0, 'errors': 0, 'bytes': 0}
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            self.counters['requests'] += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def increase(self):
+        """Additive increase, once a full window of requests went well"""
+        with self.condition:
+            self.streak += 1
+            if self.streak >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self.streak = 0
+                self.condition.notify_all()
+
+    def decrease(self):
+        """Multiplicative decrease"""
+        with self.condition:
+            self.limit = max(1, self.limit // 2)
+            self.streak = 0
+
+    def delay(self, attempt, res):
+        """Seconds to wait before retry number `attempt` + 1"""
+        wait = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = res.headers.get('Retry-After') if res is not None else None
+        if retry_after:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                try:
+                    seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    # Garbage, or a date without a time zone
+                    seconds = 0
+            wait = max(wait, min(seconds, self.max_retry_after))
+        return wait
+
+    def get(self, session, url, headers=None):
+        """GET `url`, retrying as needed.  Returns the last response, or
+        raises the last connection error once retries run out."""
+        for attempt in range(self.retries + 1):
+            res = error = None
+            self.acquire()
+            start = time.perf_counter()
+            try:
+                res = session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self.release()
+            latency = time.perf_counter() - start
+
+            if res is not None and res.status_code not in self.RETRY_STATUSES:
+                with self.condition:
+                    self.counters['bytes'] += len(res.content)
+                if latency > self.slow_after:
+                    self.decrease()
+                else:
+                    self.increase()
+                return res
+
+            with self.condition:
+                self.counters['throttled' if res is not None and res.status_code == 429 else 'errors'] += 1
+            self.decrease()
+
+            if attempt == self.retries:
+                break
+            with self.condition:
+                self.counters['retries'] += 1
+            time.sleep(self.delay(attempt, res))
+
+        if res is not None:
+            return res
+        raise error
+
+
+# *****************************************
+#              Data sources
+# *****************************************
+#
+# A data source hands out SWAPI list pages: fetch_page(resource, number, etag)
+# returns (data, etag) the same way the module level fetch_page does.
+
+
+class HttpSource:
+    """Pages fetched live from a SWAPI server through a FetchScheduler.
+
+    close() closes the session only if the source made it."""
+
+    def __init__(self, base_url=BASE_URL, concurrency=CONCURRENCY, session=None, scheduler=None):
+        self.base_url = base_url
+        self.owns_session = session is None
+        self.session = session or make_session(concurrency)
+        self.scheduler = scheduler or FetchScheduler(concurrency)
+
+    def fetch_page(self, resource, number, etag=None):
+        url = page_url(self.base_url, resource, number)
+        return fetch_page(self.session, url, etag, self.scheduler)
+
+    def close(self):
+        if self.owns_session:
+            self.session.close()
+
+
+class SnapshotSource:
+    """Pages replayed from a snapshot archive written by RecordingSource"""
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = zipfile.ZipFile(path)
+        self.lock = threading.Lock()
+
+    def fetch_page(self, resource, number, etag=None):
+        with self.lock:
+            data = json.loads(self.archive.read(f'{resource}/{number}.json'))
+        return data, None
+
+    def close(self):
+        self.archive.close()
+
+
+class RecordingSource:
+    """Wrap another source and save every page it returns into a
+    compressed snapshot archive at `path`.
+
+    Pages are always requested unconditionally so the archive is complete."""
+
+    def __init__(self, source, path):
+        self.source = source
+        self.path = path
+        self.archive = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.lock = threading.Lock()
+        self.pages = {}
+
+    def fetch_page(self, resource, number, etag=None):
+        data, etag = self.source.fetch_page(resource, number)
+        with self.lock:
+            self.archive.writestr(f'{resource}/{number}.json', json.dumps(data))
+            self.pages[resource] = max(self.pages.get(resource, 0), number)
+        return data, etag
+
+    def close(self):
+        manifest = {'source': getattr(self.source, 'base_url', None), 'pages': self.pages,
+                    'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+        self.archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+        self.archive.close()
+        self.source.close()
+
+
+def data_source(source=None, concurrency=CONCURRENCY):
+    """Turn a base url or snapshot path into a data source.
+
+    Anything that already looks like a source is returned as is."""
+    source = source or SOURCE
+    if hasattr(source, 'fetch_page'):
+        return source
+    if source.startswith(('http://', 'https://')):
+        return HttpSource(source, concurrency)
+    return SnapshotSource(source)
+
+
+def iter_pages(resource, source=None):
+    """Yield the results of each page of a resource, one request at a time"""
+    source = data_source(source)
+    number = 1
+
+    while number:
+        data, _ = source.fetch_page(resource, number)
+        yield data['results']
+        number = number + 1 if data['next'] else None
+
+
+def stream_pages(resources=RESOURCES, source=None, concurrency=CONCURRENCY, etags=None, known_pages=None,
+                 skip=None):
+    """Yield (resource, Page) for every page, in resource and page order.
+
+    The first page of every resource is requested straight away, since it
+    says how many pages follow.  After that a window of `concurrency` pages
+    is kept in flight ahead of the consumer: a new page is only requested
+    once an earlier one has been taken, so a slow consumer holds back the
+    fetching instead of letting pages pile up in memory.
+
+    `etags` maps (resource, page) to the ETag from a previous fetch, making
+    those requests conditional.  Pages in `skip`, a set of (resource, page),
+    are not requested at all and come out with no results.  When a first page
+    is unchanged or skipped the page count is taken from `known_pages`."""
+    owned = not hasattr(source, 'fetch_page')
+    source = data_source(source, concurrency)
+    etags = etags or {}
+    known_pages = known_pages or {}
+    skip = skip or set()
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+
+    def submit(resource, number):
+        if (resource, number) in skip:
+            return None
+        return pool.submit(source.fetch_page, resource, number, etags.get((resource, number)))
+
+    firsts = {resource: submit(resource, 1) for resource in resources}
+
+    def total_pages(resource):
+        data = firsts[resource].result()[0] if firsts[resource] else None
+        return page_count(data) if data is not None else known_pages.get(resource, 1)
+
+    def tasks():
+        for resource in resources:
+            yield resource, 1
+            for number in range(2, total_pages(resource) + 1):
+                yield resource, number
+
+    todo = tasks()
+    window = deque()
+
+    def fill():
+        while len(window) < concurrency:
+            task = next(todo, None)
+            if task is None:
+                return
+            resource, number = task
+            future = firsts[resource] if number == 1 else submit(resource, number)
+            window.append((resource, number, future))
+
+    try:
+        fill()
+        while window:
+            resource, number, future = window.popleft()
+            data, etag = future.result() if future else (None, etags.get((resource, number)))
+            fill()
+            results = data['results'] if data is not None else None
+            yield resource, Page(number, results, etag, total_pages(resource))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        if owned:
+            source.close()
+
+
+def fetch_resources(resources=RESOURCES, source=None, concurrency=CONCURRENCY, etags=None, known_pages=None):
+    """Fetch every page of every resource concurrently and keep them all.
+
+    Returns {resource: [Page, ...]} with pages in order."""
+    pages = {resource: [] for resource in resources}
+    for resource, page in stream_pages(resources, source, concurrency, etags, known_pages):
+        pages[resource].append(page)
+    return pages
+
+
+def upsert_statement(table):
+    """INSERT ... ON CONFLICT (primary key) DO UPDATE for `table`"""
+    dialects = {'postgresql': postgresql, 'sqlite': sqlite}
+    dialect = dialects.get(db.engine.dialect.name)
+    if dialect is None:
+        raise RuntimeError(f'Upserts are not supported on {db.engine.dialect.name}')
+
+    statement = dialect.insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[column.name for column in table.primary_key],
+        set_={column.name: statement.excluded[column.name]
+              for column in table.columns if not column.primary_key},
+    )
+
+
+class BulkLoader:
+    """Collect rows per table and write them in batches.
+
+    Each batch is one multi-row insert per table (executemany), committed in
+    a single transaction, instead of a commit per record.  Tables are written
+    in the order they were first added to the batch, so entity rows land
+    before the association rows that point at them."""
+
+    def __init__(self, batch_size=BATCH_SIZE, upsert=False):
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.batch = {}
+        self.pending = 0
+        self.rows = 0
+        self.batches = 0
+        self.elapsed = 0.0
+
+    def add(self, table, row):
+        """Queue a row for `table`, flushing once the batch is full"""
+        self.batch.setdefault(table, []).append(row)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write everything queued so far in one transaction"""
+        if not self.pending:
+            return
+
+        start = time.perf_counter()
+        try:
+            for table, rows in self.batch.items():
+                statement = upsert_statement(table) if self.upsert else table.insert()
+                db.session.execute(statement, rows)
             db.session.commit()
-
-        url= data['next']
-
-
-
-
-def fetch_and_store_species():
-    """Get json response of API data for Species"""
-    url = f'{BASE_URL}species/'
-
-    while url:
-        res = requests.get(url)
-        data = res.json()
-
-        for item in data['results']:
-            homeworld_url = item.get('homeworld')
-            if homeworld_url:
-                homeworld_id = int(item['homeworld'].split('/')[-2])
-            else:
-                homeworld_id = None
-
-            species = Species(
-                name=item['name'],
-                classification=item['classification'],
-                designation=item['designation'],
-                average_height=item['average_height'],
-                average_lifespan=item['average_lifespan'],
-                eye_colors=item['eye_colors'],
-                hair_colors=item['hair_colors'],
-                skin_colors=item['skin_colors'],
-                language=item['language'],
-                homeworld_id=homeworld_id,
-            )
-            db.session.add(species)
-            db.session.commit()
-
-            for film_url in item['films']:
-                film_id = int(film_url.split('/')[-2])
-                film = Film.query.get(film_id)
-                if film:
-                    species.films.append(film)
-
-            for person_url in item['people']:
-                person_id = int(person_url.split('/')[-2])
-                person = Person.query.get(person_id)
-                if person:
-                    species.people.append(person)
-        
-            db.session.commit()
-
-        url= data['next']
-
-
-
-
-def fetch_and_store_planets():
-    """Get json response of API data for Planets"""
-    url = f'{BASE_URL}planets/'
-
-    while url:
-        res = requests.get(url)
-        data = res.json()
-
-        for item in data['results']:
-            planet = Planet(
-                name=item['name'],
-                diameter=item['diameter'],
-                rotation_period=item['rotation_period'],
-                orbital_period=item['orbital_period'],
-                gravity=item['gravity'],
-                population=item['population'],
-                climate=item['climate'],
-                terrain=item['terrain'],
-                surface_water=item['surface_water'],
-            )
-            db.session.add(planet)
-            db.session.commit()
-
-
-            for film_url in item['films']:
-                film_id = int(film_url.split('/')[-2])
-                film = Film.query.get(film_id)
-                if film:
-                    planet.films.append(film)
-
-            for person_url in item['residents']:
-                person_id = int(person_url.split('/')[-2])
-                person = Person.query.get(person_id)
-                if person:
-                    planet.residents.append(person)
-        
-            db.session.commit()
-
-        url= data['next']
-
-
-def fetch_all_data():
-    """Fetch all data from SWAPI and store in the database"""
-    fetch_and_store_planets()
-    fetch_and_store_people()
-    fetch_and_store_films()
-    fetch_and_store_species()
-    fetch_and_store_starships()
-    fetch_and_store_vehicles()
-    
+        except Exception:
+            db.session.rollback()
+            raise
+
+        self.elapsed += time.perf_counter() - start
+        self.rows += self.pending
+        self.batches += 1
+        self.batch = {}
+        self.pending = 0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def report(self, label):
+        """Log how many rows were written and how fast"""
+        log.info('%s: %d rows in %d batches, %.2fs (%.0f rows/s)',
+                 label, self.rows, self.batches, self.elapsed, self.rows_per_second)
+
+
+# Raw SWAPI string fields that also get a parsed numeric column, <field>_num.
+# RANGE_FIELDS can hold a span like "30-165" and are split into <field>_min
+# and <field>_max.  Unknown or unparseable values become NULL.
+NUMERIC_FIELDS = {
+    'planets': ['diameter', 'rotation_period', 'orbital_period', 'population', 'surface_water'],
+    'people': ['height', 'mass'],
+    'species': ['average_height', 'average_lifespan'],
+    'starships': ['cost_in_credits', 'length', 'passengers', 'max_atmosphering_speed', 'hyperdrive_rating',
+                  'MGLT', 'cargo_capacity'],
+    'vehicles': ['cost_in_credits', 'length', 'passengers', 'max_atmosphering_speed', 'cargo_capacity'],
+}
+RANGE_FIELDS = {'starships': ['crew'], 'vehicles': ['crew']}
+
+# A number with thousands separators and an optional unit ("1,000", "1000km"),
+# or a span of two ("30-165")
+NUMBER = r'(\d[\d,]*(?:\.\d+)?|\.\d+)'
+NUMBER_RE = re.compile(NUMBER + r'\s*[a-z]*')
+RANGE_RE = re.compile(NUMBER + r'(?:\s*-\s*' + NUMBER + r')?\s*[a-z]*')
+
+
+def to_number(text):
+    text = text.replace(',', '')
+    return float(text) if '.' in text else int(text)
+
+
+def parse_number(value):
+    """Numeric value of a SWAPI string field, or None for "unknown", "n/a"
+    and anything else that is not a plain number"""
+    match = NUMBER_RE.fullmatch(value.strip().lower()) if value else None
+    return to_number(match.group(1)) if match else None
+
+
+def parse_range(value):
+    """(min, max) of a SWAPI field that may hold a span, or (None, None)"""
+    match = RANGE_RE.fullmatch(value.strip().lower()) if value else None
+    if not match:
+        return None, None
+    low = to_number(match.group(1))
+    high = to_number(match.group(2)) if match.group(2) else low
+    return low, high
+
+
+def numeric_columns(resource, item):
+    """The parsed numeric companion columns of one SWAPI record"""
+    columns = {f'{field}_num': parse_number(item[field]) for field in NUMERIC_FIELDS.get(resource, [])}
+    for field in RANGE_FIELDS.get(resource, []):
+        columns[f'{field}_min'], columns[f'{field}_max'] = parse_range(item[field])
+    return columns
+
+
+def planet_row(item):
+    """Planets table row for one SWAPI planet"""
+    return dict(
+        id=swapi_id(item['url']),
+        name=item['name'],
+        diameter=item['diameter'],
+        rotation_period=item['rotation_period'],
+        orbital_period=item['orbital_period'],
+        gravity=item['gravity'],
+        population=item['population'],
+        climate=item['climate'],
+        terrain=item['terrain'],
+        surface_water=item['surface_water'],
+        **numeric_columns('planets', item),
+    )
+
+
+def person_row(item):
+    """People table row for one SWAPI person"""
+    return dict(
+        id=swapi_id(item['url']),
+        name=item['name'],
+        birth_year=item['birth_year'],
+        eye_color=item['eye_color'],
+        gender=item['gender'],
+        hair_color=item['hair_color'],
+        height=item['height'],
+        mass=item['mass'],
+        skin_color=item['skin_color'],
+        homeworld_id=swapi_id(item['homeworld']) if item.get('homeworld') else None,
+        **numeric_columns('people', item),
+    )
+
+
+def film_row(item):
+    """Films table row for one SWAPI film"""
+    return dict(
+        id=swapi_id(item['url']),
+        title=item['title'],
+        episode_id=item['episode_id'],
+        opening_crawl=item['opening_crawl'],
+        director=item['director'],
+        producer=item['producer'],
+        release_date=date.fromisoformat(item['release_date']),
+    )
+
+
+def species_row(item):
+    """Species table row for one SWAPI species"""
+    return dict(
+        id=swapi_id(item['url']),
+        name=item['name'],
+        classification=item['classification'],
+        designation=item['designation'],
+        average_height=item['average_height'],
+        average_lifespan=item['average_lifespan'],
+        eye_colors=item['eye_colors'],
+        hair_colors=item['hair_colors'],
+        skin_colors=item['skin_colors'],
+        language=item['language'],
+        homeworld_id=swapi_id(item['homeworld']) if item.get('homeworld') else None,
+        **numeric_columns('species', item),
+    )
+
+
+def starship_row(item):
+    """Starships table row for one SWAPI starship"""
+    return dict(
+        id=swapi_id(item['url']),
+        name=item['name'],
+        model=item['model'],
+        starship_class=item['starship_class'],
+        manufacturer=item['manufacturer'],
+        cost_in_credits=item['cost_in_credits'],
+        length=item['length'],
+        crew=item['crew'],
+        passengers=item['passengers'],
+        max_atmosphering_speed=item['max_atmosphering_speed'],
+        hyperdrive_rating=item['hyperdrive_rating'],
+        MGLT=item['MGLT'],
+        cargo_capacity=item['cargo_capacity'],
+        consumables=item['consumables'],
+        **numeric_columns('starships', item),
+    )
+
+
+def vehicle_row(item):
+    """Vehicles table row for one SWAPI vehicle"""
+    return dict(
+        id=swapi_id(item['url']),
+        name=item['name'],
+        model=item['model'],
+        vehicle_class=item['vehicle_class'],
+        manufacturer=item['manufacturer'],
+        length=item['length'],
+        cost_in_credits=item['cost_in_credits'],
+        crew=item['crew'],
+        passengers=item['passengers'],
+        max_atmosphering_speed=item['max_atmosphering_speed'],
+        cargo_capacity=item['cargo_capacity'],
+        consumables=item['consumables'],
+        **numeric_columns('vehicles', item),
+    )
+
+
+# Model and row builder for each resource
+ENTITIES = {
+    'planets': (Planet, planet_row),
+    'people': (Person, person_row),
+    'films': (Film, film_row),
+    'species': (Species, species_row),
+    'starships': (Starship, starship_row),
+    'vehicles': (Vehicle, vehicle_row),
+}
+
+# Association tables and the resources their two columns point at, in column order
+LINK_TABLES = {
+    people_films: ('people', 'films'),
+    species_people: ('species', 'people'),
+    people_starships: ('people', 'starships'),
+    people_vehicles: ('people', 'vehicles'),
+    films_species: ('films', 'species'),
+    films_starships: ('films', 'starships'),
+    films_vehicles: ('films', 'vehicles'),
+    films_planets: ('films', 'planets'),
+}
+
+# Which url lists on a record feed which association table.  SWAPI lists most
+# links from both ends, so the same pair usually turns up twice.
+LINK_FIELDS = {
+    'planets': [('films', films_planets)],
+    'people': [('films', people_films), ('species', species_people),
+               ('starships', people_starships), ('vehicles', people_vehicles)],
+    'films': [('characters', people_films), ('planets', films_planets), ('species', films_species),
+              ('starships', films_starships), ('vehicles', films_vehicles)],
+    'species': [('films', films_species), ('people', species_people)],
+    'starships': [('films', films_starships), ('pilots', people_starships)],
+    'vehicles': [('films', films_vehicles), ('pilots', people_vehicles)],
+}
+
+
+def record_links(resource, item):
+    """Yield (association table, (column 1 id, column 2 id)) for every link a record names"""
+    own_id = swapi_id(item['url'])
+
+    for field, table in LINK_FIELDS[resource]:
+        first = LINK_TABLES[table][0]
+        for url in item[field]:
+            other_id = swapi_id(url)
+            yield table, (own_id, other_id) if first == resource else (other_id, own_id)
+
+
+# *****************************************
+#            Pipeline stages
+# *****************************************
+#
+# Ingest runs as a chain of generators, each pulling from the one before:
+#
+#   stream_pages -> parse_records -> normalize -> a loader
+#
+# Nothing runs further ahead than stream_pages' window of pages, so memory
+# use does not grow with the size of the dataset.  Loaders keep ids and link
+# pairs, never payloads.
+
+Record = namedtuple('Record', 'resource page item row links')
+
+
+def parse_records(pages):
+    """Split pages into (resource, page number, record)"""
+    for resource, page in pages:
+        for item in page.results or ():
+            yield resource, page.number, item
+
+
+def normalize(records):
+    """Turn records into table rows and the link pairs they name"""
+    for resource, number, item in records:
+        build_row = ENTITIES[resource][1]
+        yield Record(resource, number, item, build_row(item), list(record_links(resource, item)))
+
+
+class StageStats:
+    """Items passed and time taken by each pipeline stage.
+
+    Stages are timed from the outside, so the time measured for a stage
+    includes the stages upstream of it; summary() subtracts those to give
+    each stage's own cost."""
+
+    def __init__(self):
+        self.stages = {}
+
+    def meter(self, name, iterable):
+        """Pass `iterable` through, counting items and the time spent producing them"""
+        entry = self.stages.setdefault(name, [0, 0.0])
+        return self._metered(entry, iter(iterable))
+
+    def _metered(self, entry, iterator):
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                entry[1] += time.perf_counter() - start
+                return
+            entry[1] += time.perf_counter() - start
+            entry[0] += 1
+            yield item
+
+    def record(self, name, items, seconds):
+        """Add a stage that was timed by hand"""
+        self.stages[name] = [items, seconds]
+
+    def summary(self):
+        """{stage: (items, own seconds, items per second)}"""
+        summary = {}
+        upstream = 0.0
+        for name, (items, seconds) in self.stages.items():
+            own = max(seconds - upstream, 0.0)
+            upstream = seconds
+            summary[name] = (items, own, items / own if own else 0.0)
+        return summary
+
+    def report(self, label):
+        """Log the throughput of each stage"""
+        for name, (items, seconds, rate) in self.summary().items():
+            log.info('%s %s: %d items, %.2fs (%.0f/s)', label, name, items, seconds, rate)
+
+
+def ingest_pipeline(stages, source=None, concurrency=CONCURRENCY, etags=None, known_pages=None, skip=None,
+                    page_filter=None):
+    """Chain the fetch, parse and normalize stages, metering each.
+
+    `page_filter` is an optional extra stage run over the pages before they
+    are parsed."""
+    pages = stages.meter('fetch', stream_pages(RESOURCES, source, concurrency, etags, known_pages, skip))
+    if page_filter:
+        pages = page_filter(pages)
+    records = stages.meter('parse', parse_records(pages))
+    return stages.meter('normalize', normalize(records))
+
+
+def load_records(records, loader):
+    """Load stage of a full load, in two phases.
+
+    Phase one writes entity rows as the records stream past, remembering
+    only the ids loaded and the link pairs named.  Phase two writes the
+    association rows whose ends were both loaded, so it never has to ask the
+    database what exists."""
+    ids = {resource: set() for resource in ENTITIES}
+    links = {table: set() for table in LINK_TABLES}
+
+    for record in records:
+        row = record.row
+        if 'homeworld_id' in row and row['homeworld_id'] not in ids['planets']:
+            row['homeworld_id'] = None
+
+        loader.add(ENTITIES[record.resource][0].__table__, row)
+        ids[record.resource].add(row['id'])
+        for table, pair in record.links:
+            links[table].add(pair)
+
+    loader.flush()
+    load_links(ids, links, loader)
+
+
+def load_links(ids, links, loader):
+    """Write the association rows whose ends were both loaded"""
+    for table, pairs in links.items():
+        first, second = LINK_TABLES[table]
+        columns = [column.name for column in table.columns]
+
+        for pair in sorted(pairs):
+            if pair[0] in ids[first] and pair[1] in ids[second]:
+                loader.add(table, dict(zip(columns, pair)))
+
+    loader.flush()
+
+
+def reset_id_sequences():
+    """Move the Postgres id sequences past the SWAPI ids we inserted explicitly"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    for model in (Planet, Person, Film, Species, Starship, Vehicle):
+        table = model.__tablename__
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 1)) FROM {table}"
+        ))
+    db.session.commit()
+
+
+def bump_data_version():
+    """Mark the SWAPI tables as changed, in the current transaction"""
+    table = DataVersion.__table__
+    if not db.session.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1)).rowcount:
+        db.session.execute(table.insert().values(id=1, version=1))
+
+
+def refresh_search_vectors():
+    """Recompute the stored full-text search vectors that are out of date"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    for group in SEARCH_DOCUMENTS:
+        table = SEARCH_COLUMNS[group][0].__table__
+        vector = search_vector_expression(group)
+        db.session.execute(table.update()
+                           .where(table.c.search_vector.is_distinct_from(vector))
+                           .values(search_vector=vector))
+    db.session.commit()
+
+
+def fetch_all_data(source=None, concurrency=CONCURRENCY, batch_size=BATCH_SIZE, stages=None):
+    """Fetch all data from SWAPI and store in the database.
+
+    Pages stream through the ingest pipeline while later pages are still
+    being fetched, and are stored in batches of `batch_size` rows: every
+    entity table first, then every association table.
+
+    `source` is a SWAPI base url, the path of a snapshot archive or a data
+    source object, and defaults to SWAPI_SOURCE.  Pass a StageStats as
+    `stages` to collect per-stage timings."""
+    stages = stages if stages is not None else StageStats()
+    loader = BulkLoader(batch_size)
+
+    start = time.perf_counter()
+    load_records(ingest_pipeline(stages, source, concurrency), loader)
+    stages.record('load', loader.rows, time.perf_counter() - start)
+
+    reset_id_sequences()
+    refresh_search_vectors()
+    bump_data_version()
+    db.session.commit()
+    loader.report('fetch_all_data')
+    stages.report('fetch_all_data')
+    return loader
+
+
+def record_digest(item):
+    """Stable hash of a SWAPI record"""
+    return hashlib.sha256(json.dumps(item, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def sync_data(source=None, concurrency=CONCURRENCY, batch_size=BATCH_SIZE, stages=None, resume=True,
+              progress=None):
+    """Bring the SWAPI tables up to date without a full reseed.
+
+    List pages are requested with the ETags from the last sync, and every
+    record that comes back is compared with the version stored in
+    swapi_records (by its `edited` timestamp, then by hash).  Only new or
+    changed records are upserted, and the association tables are diffed
+    against the links named by the current records.
+
+    Entity rows are never deleted, so comments survive a sync even when a
+    record disappears upstream; only its links are removed.
+
+    Each page is checkpointed once its records are committed.  If a sync is
+    interrupted, the next one (with `resume`) skips the checkpointed pages
+    and replays their records from swapi_records instead of fetching them.
+    `progress` is called with (resource, page, total pages) after each page.
+
+    Returns counts of what changed."""
+    stages = stages if stages is not None else StageStats()
+    records_table = SwapiRecord.__table__
+    stored = {
+        (resource, id): (page, digest, edited)
+        for resource, id, page, digest, edited in db.session.execute(db.select(
+            records_table.c.resource, records_table.c.id, records_table.c.page,
+            records_table.c.digest, records_table.c.edited,
+        )).tuples()
+    }
+    etags = {(page.resource, page.page): page.etag for page in SwapiPage.query.all()}
+    known_pages = {}
+    for resource, number in etags:
+        known_pages[resource] = max(known_pages.get(resource, 0), number)
+
+    checkpoints = SyncCheckpoint.__table__
+    if not resume:
+        db.session.execute(checkpoints.delete())
+        db.session.commit()
+    skip = set()
+    for checkpoint in SyncCheckpoint.query.all():
+        skip.add((checkpoint.resource, checkpoint.page))
+        known_pages[checkpoint.resource] = checkpoint.pages
+
+    loader = BulkLoader(batch_size, upsert=True)
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'resumed_pages': len(skip),
+              'links_added': 0, 'links_removed': 0}
+    unchanged_pages = set()
+
+    def replay_stored(pages):
+        """Swap unfetched pages for the records stored from them, and save
+        each page's ETag and checkpoint once its records have been taken"""
+        for resource, page in pages:
+            if page.results is None:
+                unchanged_pages.add((resource, page.number))
+                payloads = db.session.execute(
+                    db.select(records_table.c.payload)
+                    .where(records_table.c.resource == resource, records_table.c.page == page.number)
+                    .order_by(records_table.c.id)
+                ).scalars()
+                page = page._replace(results=[json.loads(payload) for payload in payloads])
+
+            yield resource, page
+
+            # Everything from this page has been handed to the loader, so the
+            # ETag and checkpoint are committed in the same batch as its last
+            # rows or later.  An ETag saved before its records would make the
+            # next sync get a 304 and replay the stale stored payloads.
+            if page.etag:
+                loader.add(SwapiPage.__table__, dict(resource=resource, page=page.number, etag=page.etag))
+            loader.add(checkpoints, dict(resource=resource, page=page.number, pages=page.total))
+            if progress:
+                progress(resource, page.number, page.total)
+
+    ids = {resource: set() for resource in ENTITIES}
+    links = {table: set() for table in LINK_TABLES}
+    start = time.perf_counter()
+
+    for record in ingest_pipeline(stages, source, concurrency, etags, known_pages, skip, replay_stored):
+        row = record.row
+        ids[record.resource].add(row['id'])
+        for table, pair in record.links:
+            links[table].add(pair)
+
+        key = (record.resource, row['id'])
+        previous = stored.get(key)
+        if (record.resource, record.page) in unchanged_pages:
+            counts['unchanged'] += 1
+            continue
+
+        edited = record.item.get('edited')
+        digest = None
+        if not (previous and edited and previous[2] == edited):
+            digest = record_digest(record.item)
+        if previous and (digest is None or previous[1] == digest):
+            counts['unchanged'] += 1
+            if previous[0] != record.page:
+                # Moved to another page: a 304 for that page replays the
+                # records stored under it, so this one must be found there
+                loader.add(records_table, dict(
+                    resource=record.resource, id=row['id'], page=record.page, digest=previous[1],
+                    edited=previous[2], payload=json.dumps(record.item),
+                ))
+            continue
+
+        if 'homeworld_id' in row and row['homeworld_id'] not in ids['planets']:
+            row['homeworld_id'] = None
+
+        loader.add(ENTITIES[record.resource][0].__table__, row)
+        loader.add(records_table, dict(
+            resource=record.resource, id=row['id'], page=record.page, digest=digest,
+            edited=edited, payload=json.dumps(record.item),
+        ))
+        counts['updated' if previous else 'inserted'] += 1
+
+    loader.flush()
+
+    gone = [dict(resource=resource, id=id) for resource, id in stored if id not in ids[resource]]
+    if gone:
+        db.session.execute(records_table.delete().where(records_table.c.resource == bindparam('resource'),
+                                                        records_table.c.id == bindparam('id')), gone)
+
+    for table, pairs in links.items():
+        first, second = LINK_TABLES[table]
+        a, b = [column.name for column in table.columns]
+        wanted = {pair for pair in pairs if pair[0] in ids[first] and pair[1] in ids[second]}
+        existing = set(db.session.execute(db.select(table.c[a], table.c[b])).tuples())
+
+        added = [{a: x, b: y} for x, y in sorted(wanted - existing)]
+        removed = [{'x': x, 'y': y} for x, y in sorted(existing - wanted)]
+        if added:
+            db.session.execute(table.insert(), added)
+        if removed:
+            db.session.execute(table.delete().where(table.c[a] == bindparam('x'),
+                                                    table.c[b] == bindparam('y')), removed)
+        counts['links_added'] += len(added)
+        counts['links_removed'] += len(removed)
+
+    db.session.execute(checkpoints.delete())
+    # A resumed sync may find nothing left to change because the interrupted
+    # run already committed it, without ever bumping the version
+    if skip or any(counts[key] for key in ('inserted', 'updated', 'links_added', 'links_removed')):
+        bump_data_version()
+    db.session.commit()
+    stages.record('load', loader.rows + counts['links_added'] + counts['links_removed'],
+                  time.perf_counter() - start)
+
+    reset_id_sequences()
+    refresh_search_vectors()
+    log.info('sync_data: %s', counts)
+    stages.report('sync_data')
+    return counts
+
+
+class IngestLocked(RuntimeError):
+    """Raised when another process is already syncing"""
+
+
+_local_ingest_lock = threading.Lock()
+
+
+@contextmanager
+def ingest_lock():
+    """Make sure only one sync runs at a time.
+
+    On PostgreSQL this takes a session level advisory lock on a connection of
+    its own, so it holds across every worker and node sharing the database.
+    Other databases only get a lock within this process."""
+    if db.engine.dialect.name != 'postgresql':
+        if not _local_ingest_lock.acquire(blocking=False):
+            raise IngestLocked('A sync is already running in this process')
+        try:
+            yield
+        finally:
+            _local_ingest_lock.release()
+        return
+
+    with db.engine.connect() as conn:
+        locked = conn.execute(db.text('SELECT pg_try_advisory_lock(:key)'), {'key': INGEST_LOCK_KEY}).scalar()
+        conn.commit()
+        if not locked:
+            raise IngestLocked('A sync is already running against this database')
+        try:
+            yield
+        finally:
+            conn.execute(db.text('SELECT pg_advisory_unlock(:key)'), {'key': INGEST_LOCK_KEY})
+            conn.commit()
+
+
+def record_snapshot(path, source=None, concurrency=CONCURRENCY):
+    """Fetch every SWAPI page and save it to a snapshot archive at `path`.
+
+    The archive can then be passed as `source` to fetch_all_data or
+    sync_data for network-free reseeds."""
+    recorder = RecordingSource(data_source(source, concurrency), path)
+    try:
+        for _ in stream_pages(source=recorder, concurrency=concurrency):
+            pass
+    finally:
+        recorder.close()
+    return recorder.pages
@@ -0,0 +1,109 @@
+"""Add parsed numeric columns to the SWAPI tables
+
+Revision ID: 3b9d2e71c4a0
+Revises:
+Create Date: 2026-10-18 10:12:41.508213
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d2e71c4a0'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# The parsing rules of fetch.py as of this revision, copied so that later
+# changes there do not change what this migration does
+NUMERIC_FIELDS = {
+    'planets': ['diameter', 'rotation_period', 'orbital_period', 'population', 'surface_water'],
+    'people': ['height', 'mass'],
+    'species': ['average_height', 'average_lifespan'],
+    'starships': ['cost_in_credits', 'length', 'passengers', 'max_atmosphering_speed', 'hyperdrive_rating',
+                  'MGLT', 'cargo_capacity'],
+    'vehicles': ['cost_in_credits', 'length', 'passengers', 'max_atmosphering_speed', 'cargo_capacity'],
+}
+RANGE_FIELDS = {'starships': ['crew'], 'vehicles': ['crew']}
+
+NUMBER = r'(\d[\d,]*(?:\.\d+)?|\.\d+)'
+NUMBER_RE = re.compile(NUMBER + r'\s*[a-z]*')
+RANGE_RE = re.compile(NUMBER + r'(?:\s*-\s*' + NUMBER + r')?\s*[a-z]*')
+
+
+def to_number(text):
+    text = text.replace(',', '')
+    return float(text) if '.' in text else int(text)
+
+
+def parse_number(value):
+    match = NUMBER_RE.fullmatch(value.strip().lower()) if value else None
+    return to_number(match.group(1)) if match else None
+
+
+def parse_range(value):
+    match = RANGE_RE.fullmatch(value.strip().lower()) if value else None
+    if not match:
+        return None, None
+    low = to_number(match.group(1))
+    high = to_number(match.group(2)) if match.group(2) else low
+    return low, high
+
+
+def numeric_columns():
+    """(table, column, type, source field) for every numeric companion column"""
+    for table, fields in NUMERIC_FIELDS.items():
+        for field in fields:
+            yield table, f'{field}_num', sa.Float(), field
+    for table, fields in RANGE_FIELDS.items():
+        for field in fields:
+            yield table, f'{field}_min', sa.Integer(), field
+            yield table, f'{field}_max', sa.Integer(), field
+
+
+def upgrade():
+    # The app creates missing tables on startup, so a fresh database may
+    # already have these columns
+    inspector = sa.inspect(op.get_bind())
+    added = {}
+    for table, column, type_, field in numeric_columns():
+        if column in {c['name'] for c in inspector.get_columns(table)}:
+            continue
+        op.add_column(table, sa.Column(column, type_, nullable=True))
+        op.create_index(op.f(f'ix_{table}_{column}'), table, [column], unique=False)
+        added.setdefault(table, []).append((column, field))
+
+    # Fill the new columns from the raw strings already stored
+    conn = op.get_bind()
+    for table, columns in added.items():
+        fields = sorted({field for _, field in columns})
+        t = sa.table(table, sa.column('id'), *[sa.column(name) for name in fields + [c for c, _ in columns]])
+        rows = conn.execute(sa.select(t.c.id, *[t.c[field] for field in fields])).mappings().all()
+        if not rows:
+            continue
+
+        values = []
+        for row in rows:
+            parsed = {'row_id': row['id']}
+            for column, field in columns:
+                if column.endswith('_num'):
+                    parsed[f'v_{column}'] = parse_number(row[field])
+                else:
+                    low, high = parse_range(row[field])
+                    parsed[f'v_{column}'] = low if column.endswith('_min') else high
+            values.append(parsed)
+
+        update = (t.update()
+                  .where(t.c.id == sa.bindparam('row_id'))
+                  .values({column: sa.bindparam(f'v_{column}') for column, _ in columns}))
+        conn.execute(update, values)
+
+
+def downgrade():
+    for table, column, _, _ in reversed(list(numeric_columns())):
+        op.drop_index(op.f(f'ix_{table}_{column}'), table_name=table)
+        op.drop_column(table, column)
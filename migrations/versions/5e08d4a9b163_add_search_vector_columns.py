@@ -0,0 +1,68 @@
+"""Add stored full-text search vectors to the SWAPI tables
+
+Revision ID: 5e08d4a9b163
+Revises: c71e5a0f2b94
+Create Date: 2026-10-18 11:41:52.617304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5e08d4a9b163'
+down_revision = 'c71e5a0f2b94'
+branch_labels = None
+depends_on = None
+
+
+# Fields in the full-text document of each table, by tsvector weight, as of
+# this revision
+SEARCH_DOCUMENTS = {
+    'people': {'A': ['name'], 'C': ['gender', 'hair_color', 'skin_color', 'eye_color']},
+    'films': {'A': ['title'], 'B': ['director', 'producer'], 'C': ['opening_crawl']},
+    'starships': {'A': ['name'], 'B': ['model', 'manufacturer', 'starship_class']},
+    'vehicles': {'A': ['name'], 'B': ['model', 'manufacturer', 'vehicle_class']},
+    'species': {'A': ['name'], 'B': ['classification', 'designation', 'language']},
+    'planets': {'A': ['name'], 'B': ['climate', 'terrain']},
+}
+
+
+def search_vector_expression(table):
+    """SQL building the weighted english tsvector of a table's document"""
+    config = sa.cast('english', postgresql.REGCONFIG)
+    vector = None
+    for weight, fields in SEARCH_DOCUMENTS[table.name].items():
+        text = sa.func.coalesce(table.c[fields[0]], '')
+        for field in fields[1:]:
+            text = text + ' ' + sa.func.coalesce(table.c[field], '')
+        part = sa.func.setweight(sa.func.to_tsvector(config, text), weight)
+        vector = part if vector is None else vector.op('||')(part)
+    return vector
+
+
+def upgrade():
+    conn = op.get_bind()
+    is_postgres = conn.dialect.name == 'postgresql'
+    inspector = sa.inspect(conn)
+
+    search_vector = sa.Text().with_variant(postgresql.TSVECTOR(), 'postgresql')
+
+    for table, document in SEARCH_DOCUMENTS.items():
+        if 'search_vector' not in {c['name'] for c in inspector.get_columns(table)}:
+            op.add_column(table, sa.Column('search_vector', search_vector, nullable=True))
+        if not is_postgres:
+            continue
+
+        # Index and fill the vectors; ingest keeps them up to date from here
+        op.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_search_vector ON {table} USING gin (search_vector)')
+        t = sa.table(table, sa.column('search_vector'),
+                     *(sa.column(field, sa.Text()) for fields in document.values() for field in fields))
+        conn.execute(t.update().values(search_vector=search_vector_expression(t)))
+
+
+def downgrade():
+    for table in SEARCH_DOCUMENTS:
+        op.execute(f'DROP INDEX IF EXISTS ix_{table}_search_vector')
+        op.drop_column(table, 'search_vector')
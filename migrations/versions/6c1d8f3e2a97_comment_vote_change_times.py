@@ -0,0 +1,42 @@
+"""Record when each comment vote change was logged
+
+Revision ID: 6c1d8f3e2a97
+Revises: b7e3a1c95d42
+Create Date: 2026-10-18 18:47:05.318442
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6c1d8f3e2a97'
+down_revision = 'b7e3a1c95d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    if 'changed_at' not in {c['name'] for c in inspector.get_columns('comment_vote_changes')}:
+        op.add_column('comment_vote_changes', sa.Column('changed_at', sa.DateTime(), nullable=True))
+
+        # Changes already logged count as made now, so they settle before the
+        # next reconciliation repairs them
+        changes = sa.table('comment_vote_changes', sa.column('changed_at'))
+        op.execute(changes.update().values(changed_at=datetime.utcnow()))
+
+        with op.batch_alter_table('comment_vote_changes') as batch_op:
+            batch_op.alter_column('changed_at', existing_type=sa.DateTime(), nullable=False)
+
+    if 'ix_comment_vote_changes_changed_at' not in {i['name'] for i in inspector.get_indexes('comment_vote_changes')}:
+        op.create_index('ix_comment_vote_changes_changed_at', 'comment_vote_changes', ['changed_at'])
+
+
+def downgrade():
+    op.drop_index('ix_comment_vote_changes_changed_at', table_name='comment_vote_changes')
+    with op.batch_alter_table('comment_vote_changes') as batch_op:
+        batch_op.drop_column('changed_at')
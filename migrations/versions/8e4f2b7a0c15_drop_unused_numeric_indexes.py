@@ -0,0 +1,40 @@
+"""Drop the indexes on numeric columns no query filters or sorts on
+
+Revision ID: 8e4f2b7a0c15
+Revises: 6c1d8f3e2a97
+Create Date: 2026-10-18 20:31:09.774126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4f2b7a0c15'
+down_revision = '6c1d8f3e2a97'
+branch_labels = None
+depends_on = None
+
+
+# Numeric companion columns that are not list sort keys, by table
+UNUSED_INDEXES = {
+    'starships': ['passengers_num', 'MGLT_num', 'cargo_capacity_num', 'crew_max'],
+    'vehicles': ['passengers_num', 'cargo_capacity_num', 'crew_max'],
+    'planets': ['rotation_period_num', 'orbital_period_num', 'surface_water_num'],
+}
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    for table, columns in UNUSED_INDEXES.items():
+        indexes = {i['name'] for i in inspector.get_indexes(table)}
+        for column in columns:
+            if f'ix_{table}_{column}' in indexes:
+                op.drop_index(f'ix_{table}_{column}', table_name=table)
+
+
+def downgrade():
+    for table, columns in UNUSED_INDEXES.items():
+        for column in columns:
+            op.create_index(f'ix_{table}_{column}', table, [column])
@@ -0,0 +1,83 @@
+"""Replace the six comment target foreign keys with target_type/target_id
+
+Revision ID: 9a4c7e2d1f60
+Revises: 5e08d4a9b163
+Create Date: 2026-10-18 14:52:08.381925
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4c7e2d1f60'
+down_revision = '5e08d4a9b163'
+branch_labels = None
+depends_on = None
+
+
+# Old comment column, its target_type and the table it pointed at
+OLD_TARGETS = [
+    ('person_id', 'person', 'people'),
+    ('film_id', 'film', 'films'),
+    ('starship_id', 'starship', 'starships'),
+    ('vehicle_id', 'vehicle', 'vehicles'),
+    ('species_id', 'species', 'species'),
+    ('planet_id', 'planet', 'planets'),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    columns = {c['name'] for c in inspector.get_columns('comments')}
+
+    with op.batch_alter_table('comments') as batch_op:
+        if 'target_type' not in columns:
+            batch_op.add_column(sa.Column('target_type', sa.String(20), nullable=True))
+            batch_op.add_column(sa.Column('target_id', sa.Integer(), nullable=True))
+
+    old_columns = [old for old in OLD_TARGETS if old[0] in columns]
+    if old_columns:
+        comments = sa.table('comments', sa.column('target_type'), sa.column('target_id'),
+                            *(sa.column(column) for column, _, _ in old_columns))
+        op.execute(comments.update().where(comments.c.target_type.is_(None)).values(
+            target_type=sa.case(*((comments.c[column].isnot(None), target_type)
+                                  for column, target_type, _ in old_columns)),
+            target_id=sa.func.coalesce(*(comments.c[column] for column, _, _ in old_columns)),
+        ))
+
+        foreign_keys = {fk['constrained_columns'][0]: fk['name'] for fk in inspector.get_foreign_keys('comments')}
+        with op.batch_alter_table('comments') as batch_op:
+            for column, _, _ in old_columns:
+                if foreign_keys.get(column):
+                    batch_op.drop_constraint(foreign_keys[column], type_='foreignkey')
+                batch_op.drop_column(column)
+
+    # Added last: SQLite rebuilds the table to drop columns and cannot copy
+    # into a generated column
+    if 'score' not in columns:
+        op.add_column('comments', sa.Column('score', sa.Integer(), sa.Computed('upvotes - downvotes')))
+
+    if 'ix_comments_target' not in {i['name'] for i in inspector.get_indexes('comments')}:
+        op.create_index('ix_comments_target', 'comments', ['target_type', 'target_id', 'score', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_comments_target', table_name='comments')
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.drop_column('score')
+
+    with op.batch_alter_table('comments') as batch_op:
+        for column, _, table in OLD_TARGETS:
+            batch_op.add_column(sa.Column(column, sa.Integer(), nullable=True))
+            batch_op.create_foreign_key(f'comments_{column}_fkey', table, [column], ['id'], ondelete='CASCADE')
+
+    comments = sa.table('comments', sa.column('target_type'), sa.column('target_id'),
+                        *(sa.column(column) for column, _, _ in OLD_TARGETS))
+    for column, target_type, _ in OLD_TARGETS:
+        op.execute(comments.update().where(comments.c.target_type == target_type)
+                   .values({column: comments.c.target_id}))
+
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.drop_column('target_id')
+        batch_op.drop_column('target_type')
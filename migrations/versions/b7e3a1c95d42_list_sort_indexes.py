@@ -0,0 +1,49 @@
+"""Index every list sort key together with id for keyset pagination
+
+Revision ID: b7e3a1c95d42
+Revises: f2b6c0d94e18
+Create Date: 2026-10-18 18:12:36.204817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3a1c95d42'
+down_revision = 'f2b6c0d94e18'
+branch_labels = None
+depends_on = None
+
+
+# Table and the columns its lists can be sorted by
+SORT_COLUMNS = {
+    'people': ['name', 'height_num', 'mass_num'],
+    'films': ['title', 'episode_id', 'release_date'],
+    'starships': ['name', 'cost_in_credits_num', 'length_num', 'crew_min', 'max_atmosphering_speed_num',
+                  'hyperdrive_rating_num'],
+    'vehicles': ['name', 'cost_in_credits_num', 'length_num', 'crew_min', 'max_atmosphering_speed_num'],
+    'species': ['name', 'average_height_num', 'average_lifespan_num'],
+    'planets': ['name', 'population_num', 'diameter_num'],
+}
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    for table, columns in SORT_COLUMNS.items():
+        indexes = {i['name'] for i in inspector.get_indexes(table)}
+        for column in columns:
+            if f'ix_{table}_{column}_id' not in indexes:
+                op.create_index(f'ix_{table}_{column}_id', table, [column, 'id'])
+            # Superseded by the (column, id) index
+            if f'ix_{table}_{column}' in indexes:
+                op.drop_index(f'ix_{table}_{column}', table_name=table)
+
+
+def downgrade():
+    for table, columns in SORT_COLUMNS.items():
+        for column in columns:
+            op.drop_index(f'ix_{table}_{column}_id', table_name=table)
+            if column.endswith(('_num', '_min')):
+                op.create_index(f'ix_{table}_{column}', table, [column])
@@ -0,0 +1,45 @@
+"""Add pg_trgm GIN indexes on the searchable name and title columns
+
+Revision ID: c71e5a0f2b94
+Revises: 3b9d2e71c4a0
+Create Date: 2026-10-18 11:03:17.240956
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c71e5a0f2b94'
+down_revision = '3b9d2e71c4a0'
+branch_labels = None
+depends_on = None
+
+
+SEARCH_COLUMNS = [
+    ('people', 'name'),
+    ('films', 'title'),
+    ('starships', 'name'),
+    ('vehicles', 'name'),
+    ('planets', 'name'),
+    ('species', 'name'),
+]
+
+
+def upgrade():
+    # Trigram indexes are PostgreSQL only; other databases keep the plain
+    # LIKE search
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, column in SEARCH_COLUMNS:
+        op.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm '
+                   f'ON {table} USING gin ({column} gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for table, column in SEARCH_COLUMNS:
+        op.execute(f'DROP INDEX IF EXISTS ix_{table}_{column}_trgm')
@@ -0,0 +1,85 @@
+"""Add keys and indexes to comments, comment votes and the association tables
+
+Revision ID: d3f81b6a25c7
+Revises: 9a4c7e2d1f60
+Create Date: 2026-10-18 15:37:44.902113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f81b6a25c7'
+down_revision = '9a4c7e2d1f60'
+branch_labels = None
+depends_on = None
+
+
+# Association table and its two columns, in key order
+LINK_TABLES = [
+    ('people_films', 'person_id', 'film_id'),
+    ('species_people', 'species_id', 'person_id'),
+    ('people_starships', 'person_id', 'starship_id'),
+    ('people_vehicles', 'person_id', 'vehicle_id'),
+    ('films_species', 'film_id', 'species_id'),
+    ('films_starships', 'film_id', 'starship_id'),
+    ('films_vehicles', 'film_id', 'vehicle_id'),
+    ('films_planets', 'film_id', 'planet_id'),
+]
+
+
+def create_index(inspector, name, table, columns):
+    if name not in {i['name'] for i in inspector.get_indexes(table)}:
+        op.create_index(name, table, columns)
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+
+    for name, first, second in LINK_TABLES:
+        if inspector.get_pk_constraint(name)['constrained_columns']:
+            continue
+
+        # Keep one row per link, and none with a missing end
+        table = sa.table(name, sa.column(first), sa.column(second))
+        rows = conn.execute(sa.select(table.c[first], table.c[second]).distinct()
+                            .where(table.c[first].isnot(None), table.c[second].isnot(None))).all()
+        op.execute(table.delete())
+        if rows:
+            op.bulk_insert(table, [{first: a, second: b} for a, b in rows])
+
+        with op.batch_alter_table(name) as batch_op:
+            batch_op.alter_column(first, existing_type=sa.Integer(), nullable=False)
+            batch_op.alter_column(second, existing_type=sa.Integer(), nullable=False)
+            batch_op.create_primary_key(f'{name}_pkey', [first, second])
+        create_index(inspector, f'ix_{name}_{second}', name, [second])
+
+    create_index(inspector, 'ix_comments_user_id', 'comments', ['user_id', 'upvotes', 'id'])
+
+    unique = {c['name'] for c in inspector.get_unique_constraints('comment_votes')}
+    if 'uq_comment_votes_comment_id_user_id' not in unique:
+        # Only the latest vote of a user on a comment survives
+        votes = sa.table('comment_votes', sa.column('id'), sa.column('comment_id'), sa.column('user_id'))
+        latest = sa.select(sa.func.max(votes.c.id)).group_by(votes.c.comment_id, votes.c.user_id)
+        op.execute(votes.delete().where(votes.c.id.not_in(latest)))
+
+        with op.batch_alter_table('comment_votes') as batch_op:
+            batch_op.create_unique_constraint('uq_comment_votes_comment_id_user_id', ['comment_id', 'user_id'])
+    create_index(inspector, 'ix_comment_votes_user_id', 'comment_votes', ['user_id'])
+
+
+def downgrade():
+    op.drop_index('ix_comment_votes_user_id', table_name='comment_votes')
+    with op.batch_alter_table('comment_votes') as batch_op:
+        batch_op.drop_constraint('uq_comment_votes_comment_id_user_id', type_='unique')
+
+    op.drop_index('ix_comments_user_id', table_name='comments')
+
+    for name, first, second in LINK_TABLES:
+        op.drop_index(f'ix_{name}_{second}', table_name=name)
+        with op.batch_alter_table(name) as batch_op:
+            batch_op.drop_constraint(f'{name}_pkey', type_='primary')
+            batch_op.alter_column(first, existing_type=sa.Integer(), nullable=True)
+            batch_op.alter_column(second, existing_type=sa.Integer(), nullable=True)
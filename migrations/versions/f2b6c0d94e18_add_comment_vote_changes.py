@@ -0,0 +1,37 @@
+"""Add the comment vote change log read by vote reconciliation
+
+Revision ID: f2b6c0d94e18
+Revises: d3f81b6a25c7
+Create Date: 2026-10-18 16:48:21.557630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b6c0d94e18'
+down_revision = 'd3f81b6a25c7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('comment_vote_changes'):
+        op.create_table(
+            'comment_vote_changes',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('comment_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['comment_id'], ['comments.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('id'),
+        )
+
+    # Serves reconciliation and the ON DELETE CASCADE from comments
+    if 'ix_comment_vote_changes_comment_id' not in {i['name'] for i in inspector.get_indexes('comment_vote_changes')}:
+        op.create_index('ix_comment_vote_changes_comment_id', 'comment_vote_changes', ['comment_id'])
+
+
+def downgrade():
+    op.drop_index('ix_comment_vote_changes_comment_id', table_name='comment_vote_changes')
+    op.drop_table('comment_vote_changes')
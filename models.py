@@ -1,8 +1,13 @@
 """Models for Star Wars application"""
 
+from collections import defaultdict
+from datetime import datetime
+
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_
+from markupsafe import escape
+from sqlalchemy.dialects.postgresql import REGCONFIG, TSVECTOR
+from sqlalchemy.orm import foreign
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -95,51 +100,40 @@ class Comment(db.Model):
         nullable=False
     )
 
-    person_id = db.Column(
-        db.Integer,
-        db.ForeignKey('people.id', ondelete='CASCADE'),
+    target_type = db.Column(
+        db.String(20),
         nullable=True
     )
 
-    film_id = db.Column(
+    target_id = db.Column(
         db.Integer,
-        db.ForeignKey('films.id', ondelete='CASCADE'),
         nullable=True
     )
 
-    starship_id = db.Column(
+    upvotes = db.Column(
         db.Integer,
-        db.ForeignKey('starships.id', ondelete='CASCADE'),
-        nullable=True
+        default=0
     )
 
-    vehicle_id = db.Column(
+    downvotes = db.Column(
         db.Integer,
-        db.ForeignKey('vehicles.id', ondelete='CASCADE'),
-        nullable=True
+        default=0
     )
 
-    species_id = db.Column(
-        db.Integer,
-        db.ForeignKey('species.id', ondelete='CASCADE'),
-        nullable=True
-    )
-    
-    planet_id = db.Column(
+    score = db.Column(
         db.Integer,
-        db.ForeignKey('planets.id', ondelete='CASCADE'),
-        nullable=True
+        db.Computed('upvotes - downvotes')
     )
 
-    upvotes = db.Column(
-        db.Integer,
-        default=0
+    __table_args__ = (
+        db.Index('ix_comments_target', 'target_type', 'target_id', 'score', 'id'),
+        db.Index('ix_comments_user_id', 'user_id', 'upvotes', 'id'),
     )
 
-    downvotes = db.Column(
-        db.Integer,
-        default=0
-    )
+    @classmethod
+    def about(cls, element, **kwargs):
+        """A new comment on `element`, an instance of one of the COMMENT_TARGETS models"""
+        return cls(target_type=COMMENT_TYPES[type(element)], target_id=element.id, **kwargs)
 
 
 class CommentVote(db.Model):
@@ -169,6 +163,38 @@ class CommentVote(db.Model):
         nullable=False
     )
 
+    __table_args__ = (
+        db.UniqueConstraint('comment_id', 'user_id', name='uq_comment_votes_comment_id_user_id'),
+        db.Index('ix_comment_votes_user_id', 'user_id'),
+    )
+
+
+class CommentVoteChange(db.Model):
+    """A comment whose votes changed since the last vote reconciliation"""
+
+    __tablename__ = 'comment_vote_changes'
+    __table_args__ = (
+        db.Index('ix_comment_vote_changes_comment_id', 'comment_id'),
+        db.Index('ix_comment_vote_changes_changed_at', 'changed_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+
+    comment_id = db.Column(
+        db.Integer,
+        db.ForeignKey('comments.id', ondelete='CASCADE'),
+        nullable=False
+    )
+
+    changed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow
+    )
+
 
 
 
@@ -177,12 +203,23 @@ class CommentVote(db.Model):
 # *****************************************
 
 
+# Weighted full-text document of a SWAPI record, kept up to date by ingest.
+# A tsvector with a GIN index on PostgreSQL and unused elsewhere.
+SearchVector = db.Text().with_variant(TSVECTOR(), 'postgresql')
+
+
 
 
 class Person(db.Model):
     """A character in the star wars universe"""
 
     __tablename__ = 'people'
+    __table_args__ = (
+        db.Index('ix_people_search_vector', 'search_vector', postgresql_using='gin').ddl_if(dialect='postgresql'),
+        db.Index('ix_people_name_id', 'name', 'id'),
+        db.Index('ix_people_height_num_id', 'height_num', 'id'),
+        db.Index('ix_people_mass_num_id', 'mass_num', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -222,6 +259,18 @@ class Person(db.Model):
         db.String
     )
 
+    height_num = db.Column(
+        db.Float
+    )
+
+    mass_num = db.Column(
+        db.Float
+    )
+
+    search_vector = db.Column(
+        SearchVector
+    )
+
     homeworld_id = db.Column(db.Integer, db.ForeignKey('planets.id'))
 
     films = db.relationship('Film', secondary='people_films', back_populates='characters')
@@ -232,14 +281,17 @@ class Person(db.Model):
 
     vehicles = db.relationship('Vehicle', secondary='people_vehicles', back_populates='pilots')
 
-    comments = db.relationship('Comment', backref='person', lazy=True)
-
-
 
 class Film(db.Model):
     """Film model"""
 
     __tablename__ = 'films'
+    __table_args__ = (
+        db.Index('ix_films_search_vector', 'search_vector', postgresql_using='gin').ddl_if(dialect='postgresql'),
+        db.Index('ix_films_title_id', 'title', 'id'),
+        db.Index('ix_films_episode_id_id', 'episode_id', 'id'),
+        db.Index('ix_films_release_date_id', 'release_date', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -271,6 +323,10 @@ class Film(db.Model):
         db.Date
     )
 
+    search_vector = db.Column(
+        SearchVector
+    )
+
     species = db.relationship('Species', secondary='films_species', back_populates='films')
 
     starships = db.relationship('Starship', secondary='films_starships', back_populates='films')
@@ -281,13 +337,20 @@ class Film(db.Model):
 
     planets = db.relationship('Planet', secondary='films_planets', back_populates='films')
 
-    comments = db.relationship('Comment', backref='film', lazy=True)
-
 
 class Starship(db.Model):
     """Starship model"""
 
     __tablename__ = 'starships'
+    __table_args__ = (
+        db.Index('ix_starships_search_vector', 'search_vector', postgresql_using='gin').ddl_if(dialect='postgresql'),
+        db.Index('ix_starships_name_id', 'name', 'id'),
+        db.Index('ix_starships_cost_in_credits_num_id', 'cost_in_credits_num', 'id'),
+        db.Index('ix_starships_length_num_id', 'length_num', 'id'),
+        db.Index('ix_starships_crew_min_id', 'crew_min', 'id'),
+        db.Index('ix_starships_max_atmosphering_speed_num_id', 'max_atmosphering_speed_num', 'id'),
+        db.Index('ix_starships_hyperdrive_rating_num_id', 'hyperdrive_rating_num', 'id'),
+    )
 
     id = db.Column(
         db.Integer, 
@@ -347,18 +410,63 @@ class Starship(db.Model):
         db.String
     )
 
-    pilots = db.relationship('Person', secondary='people_starships', back_populates='starships')
+    cost_in_credits_num = db.Column(
+        db.Float
+    )
 
-    films = db.relationship('Film', secondary='films_starships', back_populates='starships')
+    length_num = db.Column(
+        db.Float
+    )
+
+    passengers_num = db.Column(
+        db.Float
+    )
+
+    max_atmosphering_speed_num = db.Column(
+        db.Float
+    )
+
+    hyperdrive_rating_num = db.Column(
+        db.Float
+    )
+
+    MGLT_num = db.Column(
+        db.Float
+    )
+
+    cargo_capacity_num = db.Column(
+        db.Float
+    )
+
+    crew_min = db.Column(
+        db.Integer
+    )
+
+    crew_max = db.Column(
+        db.Integer
+    )
+
+    search_vector = db.Column(
+        SearchVector
+    )
 
-    comments = db.relationship('Comment', backref='starship', lazy=True)
+    pilots = db.relationship('Person', secondary='people_starships', back_populates='starships')
 
+    films = db.relationship('Film', secondary='films_starships', back_populates='starships')
 
 
 class Vehicle(db.Model):
     """Vehicle model"""
 
     __tablename__ = 'vehicles'
+    __table_args__ = (
+        db.Index('ix_vehicles_search_vector', 'search_vector', postgresql_using='gin').ddl_if(dialect='postgresql'),
+        db.Index('ix_vehicles_name_id', 'name', 'id'),
+        db.Index('ix_vehicles_cost_in_credits_num_id', 'cost_in_credits_num', 'id'),
+        db.Index('ix_vehicles_length_num_id', 'length_num', 'id'),
+        db.Index('ix_vehicles_crew_min_id', 'crew_min', 'id'),
+        db.Index('ix_vehicles_max_atmosphering_speed_num_id', 'max_atmosphering_speed_num', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -410,19 +518,53 @@ class Vehicle(db.Model):
         db.String
     )
 
+    cost_in_credits_num = db.Column(
+        db.Float
+    )
 
-    pilots = db.relationship('Person', secondary='people_vehicles', back_populates='vehicles')
+    length_num = db.Column(
+        db.Float
+    )
 
-    films = db.relationship('Film', secondary='films_vehicles', back_populates='vehicles')
+    passengers_num = db.Column(
+        db.Float
+    )
+
+    max_atmosphering_speed_num = db.Column(
+        db.Float
+    )
+
+    cargo_capacity_num = db.Column(
+        db.Float
+    )
+
+    crew_min = db.Column(
+        db.Integer
+    )
+
+    crew_max = db.Column(
+        db.Integer
+    )
+
+    search_vector = db.Column(
+        SearchVector
+    )
 
-    comments = db.relationship('Comment', backref='vehicle', lazy=True)
+    pilots = db.relationship('Person', secondary='people_vehicles', back_populates='vehicles')
 
+    films = db.relationship('Film', secondary='films_vehicles', back_populates='vehicles')
 
 
 class Species(db.Model):
     """Species model"""
 
     __tablename__ = 'species'
+    __table_args__ = (
+        db.Index('ix_species_search_vector', 'search_vector', postgresql_using='gin').ddl_if(dialect='postgresql'),
+        db.Index('ix_species_name_id', 'name', 'id'),
+        db.Index('ix_species_average_height_num_id', 'average_height_num', 'id'),
+        db.Index('ix_species_average_lifespan_num_id', 'average_lifespan_num', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -466,6 +608,18 @@ class Species(db.Model):
         db.String
     )
 
+    average_height_num = db.Column(
+        db.Float
+    )
+
+    average_lifespan_num = db.Column(
+        db.Float
+    )
+
+    search_vector = db.Column(
+        SearchVector
+    )
+
     homeworld_id = db.Column(db.Integer, db.ForeignKey('planets.id'))
 
     homeworld = db.relationship('Planet', backref='species')
@@ -474,13 +628,17 @@ class Species(db.Model):
 
     people = db.relationship('Person', secondary='species_people', back_populates='species')
 
-    comments = db.relationship('Comment', backref='species', lazy=True)
-
 
 class Planet(db.Model):
     """Planet Model"""
 
     __tablename__ = 'planets'
+    __table_args__ = (
+        db.Index('ix_planets_search_vector', 'search_vector', postgresql_using='gin').ddl_if(dialect='postgresql'),
+        db.Index('ix_planets_name_id', 'name', 'id'),
+        db.Index('ix_planets_population_num_id', 'population_num', 'id'),
+        db.Index('ix_planets_diameter_num_id', 'diameter_num', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -524,107 +682,446 @@ class Planet(db.Model):
         db.String
     )
 
+    diameter_num = db.Column(
+        db.Float
+    )
+
+    rotation_period_num = db.Column(
+        db.Float
+    )
+
+    orbital_period_num = db.Column(
+        db.Float
+    )
+
+    population_num = db.Column(
+        db.Float
+    )
+
+    surface_water_num = db.Column(
+        db.Float
+    )
+
+    search_vector = db.Column(
+        SearchVector
+    )
+
     residents = db.relationship('Person', backref='homeworld')
 
     films = db.relationship('Film', secondary='films_planets', back_populates='planets')
 
-    comments = db.relationship('Comment', backref='planet', lazy=True)
-
 # *****************************************
 #          Relationship tables
 # *****************************************
 
 
+# Each link is stored once: the primary key serves lookups from the first
+# column's side and the index lookups from the second's
 people_films = db.Table('people_films',
-    db.Column('person_id', db.Integer, db.ForeignKey('people.id')),
-    db.Column('film_id', db.Integer, db.ForeignKey('films.id'))
+    db.Column('person_id', db.Integer, db.ForeignKey('people.id'), primary_key=True),
+    db.Column('film_id', db.Integer, db.ForeignKey('films.id'), primary_key=True),
+    db.Index('ix_people_films_film_id', 'film_id')
 )
 
 species_people = db.Table('species_people',
-    db.Column('species_id', db.Integer, db.ForeignKey('species.id')),
-    db.Column('person_id', db.Integer, db.ForeignKey('people.id'))
+    db.Column('species_id', db.Integer, db.ForeignKey('species.id'), primary_key=True),
+    db.Column('person_id', db.Integer, db.ForeignKey('people.id'), primary_key=True),
+    db.Index('ix_species_people_person_id', 'person_id')
 )
 
 people_starships = db.Table('people_starships',
-    db.Column('person_id', db.Integer, db.ForeignKey('people.id')),
-    db.Column('starship_id', db.Integer, db.ForeignKey('starships.id'))
+    db.Column('person_id', db.Integer, db.ForeignKey('people.id'), primary_key=True),
+    db.Column('starship_id', db.Integer, db.ForeignKey('starships.id'), primary_key=True),
+    db.Index('ix_people_starships_starship_id', 'starship_id')
 )
 
 people_vehicles = db.Table('people_vehicles',
-    db.Column('person_id', db.Integer, db.ForeignKey('people.id')),
-    db.Column('vehicle_id', db.Integer, db.ForeignKey('vehicles.id'))
+    db.Column('person_id', db.Integer, db.ForeignKey('people.id'), primary_key=True),
+    db.Column('vehicle_id', db.Integer, db.ForeignKey('vehicles.id'), primary_key=True),
+    db.Index('ix_people_vehicles_vehicle_id', 'vehicle_id')
 )
 
 
 films_species = db.Table('films_species',
-    db.Column('film_id', db.Integer, db.ForeignKey('films.id')),
-    db.Column('species_id', db.Integer, db.ForeignKey('species.id'))
+    db.Column('film_id', db.Integer, db.ForeignKey('films.id'), primary_key=True),
+    db.Column('species_id', db.Integer, db.ForeignKey('species.id'), primary_key=True),
+    db.Index('ix_films_species_species_id', 'species_id')
 )
 
 films_starships = db.Table('films_starships',
-    db.Column('film_id', db.Integer, db.ForeignKey('films.id')),
-    db.Column('starship_id', db.Integer, db.ForeignKey('starships.id'))
+    db.Column('film_id', db.Integer, db.ForeignKey('films.id'), primary_key=True),
+    db.Column('starship_id', db.Integer, db.ForeignKey('starships.id'), primary_key=True),
+    db.Index('ix_films_starships_starship_id', 'starship_id')
 )
 
 films_vehicles = db.Table('films_vehicles',
-    db.Column('film_id', db.Integer, db.ForeignKey('films.id')),
-    db.Column('vehicle_id', db.Integer, db.ForeignKey('vehicles.id'))
+    db.Column('film_id', db.Integer, db.ForeignKey('films.id'), primary_key=True),
+    db.Column('vehicle_id', db.Integer, db.ForeignKey('vehicles.id'), primary_key=True),
+    db.Index('ix_films_vehicles_vehicle_id', 'vehicle_id')
 )
 
 films_planets = db.Table('films_planets',
-    db.Column('film_id', db.Integer, db.ForeignKey('films.id')),
-    db.Column('planet_id', db.Integer, db.ForeignKey('planets.id'))
+    db.Column('film_id', db.Integer, db.ForeignKey('films.id'), primary_key=True),
+    db.Column('planet_id', db.Integer, db.ForeignKey('planets.id'), primary_key=True),
+    db.Index('ix_films_planets_planet_id', 'planet_id')
 )
 
 
 
-def search_elements(search_query):
-    """Search database"""
-    search_query = search_query.strip()
 
-    people_exact = Person.query.filter(Person.name.ilike(f"%{search_query}%")).all()
+# *****************************************
+#             Ingest state
+# *****************************************
+
+
+class SwapiRecord(db.Model):
+    """Last version of a SWAPI record seen by the incremental sync"""
+
+    __tablename__ = 'swapi_records'
+
+    resource = db.Column(
+        db.String,
+        primary_key=True
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False
+    )
+
+    page = db.Column(
+        db.Integer,
+        nullable=False
+    )
+
+    digest = db.Column(
+        db.String(64),
+        nullable=False
+    )
+
+    edited = db.Column(
+        db.String
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+
+class SwapiPage(db.Model):
+    """ETag of a SWAPI list page, used for conditional requests"""
+
+    __tablename__ = 'swapi_pages'
+
+    resource = db.Column(
+        db.String,
+        primary_key=True
+    )
+
+    page = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False
+    )
+
+    etag = db.Column(
+        db.String
+    )
+
+
+class DataVersion(db.Model):
+    """Counter bumped by every ingest that changes the SWAPI tables, so
+    processes holding derived data (search index, caches) can tell it is
+    stale"""
+
+    __tablename__ = 'swapi_data_version'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+
+class SyncCheckpoint(db.Model):
+    """A SWAPI list page fully loaded by a sync that has not finished yet"""
+
+    __tablename__ = 'swapi_sync_checkpoints'
 
-    films_exact = Film.query.filter(Film.title.ilike(f"%{search_query}%")).all()
+    resource = db.Column(
+        db.String,
+        primary_key=True
+    )
+
+    page = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False
+    )
 
-    starships_exact = Starship.query.filter(Starship.name.ilike(f"%{search_query}%")).all()
+    pages = db.Column(
+        db.Integer,
+        nullable=False
+    )
 
-    vehicles_exact = Vehicle.query.filter(Vehicle.name.ilike(f"%{search_query}%")).all()
 
-    planets_exact = Planet.query.filter(Planet.name.ilike(f"%{search_query}%")).all()
 
-    species_exact = Species.query.filter(Species.name.ilike(f"%{search_query}%")).all()
+# Searchable column of each SWAPI model, keyed by the result group in the
+# /search JSON, with the type and field name each result is given
+SEARCH_COLUMNS = {
+    'people': (Person, 'person', 'name'),
+    'films': (Film, 'film', 'title'),
+    'starships': (Starship, 'starship', 'name'),
+    'vehicles': (Vehicle, 'vehicle', 'name'),
+    'planets': (Planet, 'planet', 'name'),
+    'species': (Species, 'species', 'name'),
+}
 
+# Most results returned per group
+SEARCH_LIMIT = 10
 
-    people_partial = Person.query.filter(Person.name.ilike(f"%{search_query}%")).all()
+# Lowest pg_trgm word similarity a fuzzy match may have
+FUZZY_THRESHOLD = 0.4
 
-    films_partial = Film.query.filter(Film.title.ilike(f"%{search_query}%")).all()
 
-    starships_partial = Starship.query.filter(Starship.name.ilike(f"%{search_query}%")).all()
+def search_elements(search_query, limit=SEARCH_LIMIT):
+    """Search the names and titles of every SWAPI model.
 
-    vehicles_partial = Vehicle.query.filter(Vehicle.name.ilike(f"%{search_query}%")).all()
+    Runs as a single UNION ALL statement returning at most `limit` matches
+    per group, ordered by name."""
+    search_query = search_query.strip()
 
-    planets_partial = Planet.query.filter(Planet.name.ilike(f"%{search_query}%")).all()
+    selects = []
+    for group, (model, type_, field) in SEARCH_COLUMNS.items():
+        label = getattr(model, field)
+        select = (db.select(db.literal(group).label('grp'), model.id.label('id'), label.label('label'))
+                  .where(label.icontains(search_query, autoescape=True))
+                  .order_by(label)
+                  .limit(limit))
+        selects.append(select.subquery().select())
 
-    species_partial = Species.query.filter(Species.name.ilike(f"%{search_query}%")).all()
+    results = {group: [] for group in SEARCH_COLUMNS}
+    for group, id, label in db.session.execute(db.union_all(*selects)):
+        _, type_, field = SEARCH_COLUMNS[group]
+        results[group].append({field: label, 'type': type_, 'id': id})
 
+    return results
 
-    people = list(dict.fromkeys(people_exact + people_partial))
-    films = list(dict.fromkeys(films_exact + films_partial))
-    starships = list(dict.fromkeys(starships_exact + starships_partial))
-    vehicles = list(dict.fromkeys(vehicles_exact + vehicles_partial))
-    planets = list(dict.fromkeys(planets_exact + planets_partial))
-    species = list(dict.fromkeys(species_exact + species_partial))
 
-    results = {
-        'people': [{'name': person.name, 'type': 'person', 'id': person.id} for person in people],
-        'films': [{'title': film.title, 'type': 'film', 'id': film.id} for film in films],
-        'starships': [{'name': starship.name, 'type': 'starship', 'id': starship.id} for starship in starships],
-        'vehicles': [{'name': vehicle.name, 'type': 'vehicle', 'id': vehicle.id} for vehicle in vehicles],
-        'planets' : [{'name': planet.name, 'type': 'planet', 'id': planet.id} for planet in planets],
-        'species' : [{'name': species.name, 'type': 'species', 'id': species.id} for species in species]
-    }
+def fuzzy_search_elements(search_query, limit=SEARCH_LIMIT, threshold=FUZZY_THRESHOLD):
+    """Typo-tolerant search of the names and titles on PostgreSQL.
 
-    return results 
+    Matches names with a word similar to the query ("skywlker" finds "Luke
+    Skywalker") using pg_trgm's <% operator, which the trigram GIN indexes
+    serve, best match first.  Other databases fall back to
+    search_elements()."""
+    search_query = search_query.strip()
+    if db.engine.dialect.name != 'postgresql' or not search_query:
+        return search_elements(search_query, limit)
+
+    db.session.execute(db.select(db.func.set_config('pg_trgm.word_similarity_threshold', str(threshold), True)))
+
+    selects = []
+    for group, (model, type_, field) in SEARCH_COLUMNS.items():
+        label = getattr(model, field)
+        score = db.func.word_similarity(search_query, label)
+        select = (db.select(db.literal(group).label('grp'), model.id.label('id'), label.label('label'))
+                  .where(db.literal(search_query).op('<%')(label))
+                  .order_by(score.desc(), label)
+                  .limit(limit))
+        selects.append(select.subquery().select())
+
+    results = {group: [] for group in SEARCH_COLUMNS}
+    for group, id, label in db.session.execute(db.union_all(*selects)):
+        _, type_, field = SEARCH_COLUMNS[group]
+        results[group].append({field: label, 'type': type_, 'id': id})
+
+    return results
+
+
+# Fields in the full-text document of each SWAPI model, by tsvector weight
+SEARCH_DOCUMENTS = {
+    'people': {'A': ['name'], 'C': ['gender', 'hair_color', 'skin_color', 'eye_color']},
+    'films': {'A': ['title'], 'B': ['director', 'producer'], 'C': ['opening_crawl']},
+    'starships': {'A': ['name'], 'B': ['model', 'manufacturer', 'starship_class']},
+    'vehicles': {'A': ['name'], 'B': ['model', 'manufacturer', 'vehicle_class']},
+    'species': {'A': ['name'], 'B': ['classification', 'designation', 'language']},
+    'planets': {'A': ['name'], 'B': ['climate', 'terrain']},
+}
+
+# PostgreSQL text search configuration, and how ts_headline cuts snippets
+TEXT_SEARCH_CONFIG = 'english'
+HEADLINE_OPTIONS = 'MaxWords=20, MinWords=8, MaxFragments=2'
+
+# ts_rank's default weight of each tsvector weight, used to rank the fallback
+WEIGHT_RANKS = {'A': 1.0, 'B': 0.4, 'C': 0.2}
+
+
+def search_text(model, fields):
+    """SQL joining `fields` of `model` with spaces, NULLs as empty strings"""
+    text = db.func.coalesce(getattr(model, fields[0]), '')
+    for field in fields[1:]:
+        text = text + ' ' + db.func.coalesce(getattr(model, field), '')
+    return text
+
+
+def search_vector_expression(group):
+    """SQL building the weighted tsvector stored in a model's search_vector"""
+    model = SEARCH_COLUMNS[group][0]
+    config = db.cast(TEXT_SEARCH_CONFIG, REGCONFIG)
+    vector = None
+    for weight, fields in SEARCH_DOCUMENTS[group].items():
+        part = db.func.setweight(db.func.to_tsvector(config, search_text(model, fields)), weight)
+        vector = part if vector is None else vector.op('||')(part)
+    return vector
+
+
+def snippet_fields(group):
+    """The descriptive (not name or title) fields of a group's document"""
+    return [field for weight, fields in SEARCH_DOCUMENTS[group].items() if weight != 'A' for field in fields]
+
+
+def full_text_search(search_query, limit=SEARCH_LIMIT):
+    """Ranked full-text search over the descriptive fields of every SWAPI model.
+
+    On PostgreSQL the stored search vectors are matched against
+    websearch_to_tsquery, ranked with ts_rank and given a ts_headline
+    snippet, in a single UNION ALL statement.  Other databases fall back to
+    a substring match over the same fields.  Results are grouped like
+    search_elements(), best first, with a `rank` and an HTML `snippet`."""
+    search_query = search_query.strip()
+    results = {group: [] for group in SEARCH_COLUMNS}
+    if not search_query:
+        return results
+
+    if db.engine.dialect.name == 'postgresql':
+        rows = postgres_text_search(search_query, limit)
+    else:
+        rows = fallback_text_search(search_query, limit)
+
+    for group, id, label, rank, snippet in sorted(rows, key=lambda row: -row[3]):
+        _, type_, field = SEARCH_COLUMNS[group]
+        results[group].append({field: label, 'type': type_, 'id': id, 'rank': round(rank, 4),
+                               'snippet': snippet})
+    return results
+
+
+def postgres_text_search(search_query, limit):
+    config = db.cast(TEXT_SEARCH_CONFIG, REGCONFIG)
+    tsquery = db.func.websearch_to_tsquery(config, search_query)
+
+    selects = []
+    for group, (model, _, field) in SEARCH_COLUMNS.items():
+        label = getattr(model, field)
+        rank = db.func.ts_rank(model.search_vector, tsquery)
+        matches = (db.select(db.literal(group).label('grp'), model.id.label('id'), label.label('label'),
+                             rank.label('rank'), search_text(model, snippet_fields(group)).label('document'))
+                   .where(model.search_vector.op('@@')(tsquery))
+                   .order_by(rank.desc(), label)
+                   .limit(limit)
+                   .subquery())
+        snippet = db.func.ts_headline(config, escape_html(matches.c.document), tsquery, HEADLINE_OPTIONS)
+        selects.append(db.select(matches.c.grp, matches.c.id, matches.c.label, matches.c.rank, snippet))
+
+    return db.session.execute(db.union_all(*selects)).all()
+
+
+def fallback_text_search(search_query, limit):
+    """Substring version of the full-text search for databases without it,
+    ranked by the best weighted field that matched"""
+    selects = []
+    for group, (model, _, field) in SEARCH_COLUMNS.items():
+        label = getattr(model, field)
+        hits = {weight: db.or_(*[getattr(model, f).icontains(search_query, autoescape=True) for f in fields])
+                for weight, fields in SEARCH_DOCUMENTS[group].items()}
+        rank = db.case(*[(hit, WEIGHT_RANKS[weight]) for weight, hit in hits.items()], else_=0.0)
+        matches = (db.select(db.literal(group).label('grp'), model.id.label('id'), label.label('label'),
+                             rank.label('rank'), search_text(model, snippet_fields(group)).label('document'))
+                   .where(db.or_(*hits.values()))
+                   .order_by(rank.desc(), label)
+                   .limit(limit))
+        selects.append(matches.subquery().select())
+
+    return [(group, id, label, rank, highlight(document, search_query))
+            for group, id, label, rank, document in db.session.execute(db.union_all(*selects))]
+
+
+def escape_html(text):
+    """SQL HTML-escaping `text` the way markupsafe.escape does, so that the
+    only markup in a ts_headline snippet is its own <b> tags"""
+    for char, entity in (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&#34;'), ("'", '&#39;')):
+        text = db.func.replace(text, char, entity)
+    return text
+
+
+def highlight(text, search_query, context=40):
+    """A ts_headline-like snippet of `text` around the first `search_query`,
+    HTML-escaped but for the <b> tags around the match"""
+    start = text.lower().find(search_query.lower())
+    if start < 0:
+        return ' '.join(escape(text).split()[:20])
+    end = start + len(search_query)
+    before = escape(text[max(0, start - context):start])
+    after = escape(text[end:end + context])
+    return ' '.join(f'{before}<b>{escape(text[start:end])}</b>{after}'.split())
+
+
+# What Comment.target_type names, for each kind of entity a comment can be
+# about.  A new commentable model only needs an entry here.
+COMMENT_TARGETS = {
+    'person': Person,
+    'film': Film,
+    'starship': Starship,
+    'vehicle': Vehicle,
+    'species': Species,
+    'planet': Planet,
+}
+
+COMMENT_TYPES = {model: target_type for target_type, model in COMMENT_TARGETS.items()}
+
+# `<model>.comments`: the comments on an entity, best scored first, which
+# is the order of the ix_comments_target index
+for _target_type, _model in COMMENT_TARGETS.items():
+    _model.comments = db.relationship(
+        Comment,
+        primaryjoin=db.and_(Comment.target_type == _target_type, foreign(Comment.target_id) == _model.id),
+        order_by=(Comment.score.desc(), Comment.id.desc()),
+        viewonly=True
+    )
+
+
+def comment_target_key(comment):
+    """(model, id) of the entity a comment is about, or None"""
+    model = COMMENT_TARGETS.get(comment.target_type)
+    if model is None or comment.target_id is None:
+        return None
+    return model, comment.target_id
+
+
+def load_comment_targets(comments):
+    """The entity each comment is about, in the order of `comments`.
+
+    Target ids are grouped by type and each type is loaded with one IN
+    query, however many comments there are."""
+    keys = [comment_target_key(comment) for comment in comments]
+    ids = defaultdict(set)
+    for key in keys:
+        if key:
+            ids[key[0]].add(key[1])
+
+    loaded = {}
+    for model, target_ids in ids.items():
+        for element in db.session.execute(db.select(model).where(model.id.in_(target_ids))).scalars():
+            loaded[model, element.id] = element
+
+    return [loaded.get(key) if key else None for key in keys]
 
 
 def connect_db(app):
@@ -0,0 +1,114 @@
+"""Keyset pagination for the SWAPI list pages.
+
+Pages are cut with a WHERE on the last row seen instead of an OFFSET, so
+each page costs the same however deep into the list it is.  Rows are
+ordered by the sort column, NULLs last, then by id to break ties; the
+`after` cursor carries the sort value and id of the last row of a page.
+Every sort column has an index on (column, id) in models.py."""
+
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import date
+
+from models import db, Person, Film, Starship, Vehicle, Species, Planet
+
+# Rows per list page
+PAGE_SIZE = 25
+
+# Sort keys offered on each list page, the first one being the default
+LIST_SORTS = {
+    Person: {'name': Person.name, 'height': Person.height_num, 'mass': Person.mass_num},
+    Film: {'title': Film.title, 'episode': Film.episode_id, 'release_date': Film.release_date},
+    Starship: {'name': Starship.name, 'cost': Starship.cost_in_credits_num, 'length': Starship.length_num,
+               'crew': Starship.crew_min, 'speed': Starship.max_atmosphering_speed_num,
+               'hyperdrive': Starship.hyperdrive_rating_num},
+    Vehicle: {'name': Vehicle.name, 'cost': Vehicle.cost_in_credits_num, 'length': Vehicle.length_num,
+              'crew': Vehicle.crew_min, 'speed': Vehicle.max_atmosphering_speed_num},
+    Species: {'name': Species.name, 'height': Species.average_height_num,
+              'lifespan': Species.average_lifespan_num},
+    Planet: {'name': Planet.name, 'population': Planet.population_num, 'diameter': Planet.diameter_num},
+}
+
+Page = namedtuple('Page', 'items sort order after next_cursor sorts')
+
+
+class BadCursor(ValueError):
+    """Raised for an `after` cursor that cannot be decoded"""
+
+
+def encode_cursor(value, id):
+    if isinstance(value, date):
+        value = value.isoformat()
+    raw = json.dumps([value, id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, column):
+    """(sort value, id) from a cursor made by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, id = json.loads(raw)
+        if value is not None and column.type.python_type is date:
+            value = date.fromisoformat(value)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise BadCursor(f'Bad cursor: {cursor}') from e
+
+    # JSON numbers may come back as int for a float column; booleans are ints
+    expected = column.type.python_type
+    if expected is float:
+        expected = (int, float)
+    if (not isinstance(id, int) or isinstance(id, bool)
+            or value is not None and (isinstance(value, bool) or not isinstance(value, expected))):
+        raise BadCursor(f'Bad cursor: {cursor}')
+    return value, id
+
+
+def paginate(query, model, column, descending=False, after=None, page_size=PAGE_SIZE):
+    """(rows, next cursor) for one page of a select of `model` rows, sorted
+    by `column`.  Raises BadCursor for a cursor that cannot be decoded.
+
+    Rows with a sort value come first and are read by seeking past the
+    cursor with (column, id) compared as a row value, which an index on
+    (column, id) can start from.  The rows without one follow in id order,
+    as a second query once the first runs out."""
+    value, id = decode_cursor(after, column) if after else (None, None)
+    direction = (lambda c: c.desc()) if descending else (lambda c: c.asc())
+
+    items = []
+    if not after or value is not None:
+        seek = query.where(column.isnot(None))
+        if after:
+            key, last = db.tuple_(column, model.id), db.tuple_(db.literal(value, column.type), id)
+            seek = seek.where(key < last if descending else key > last)
+        seek = seek.order_by(direction(column), direction(model.id)).limit(page_size + 1)
+        items = db.session.execute(seek).scalars().all()
+
+    if len(items) <= page_size:
+        nulls = query.where(column.is_(None))
+        if after and value is None:
+            nulls = nulls.where(model.id < id if descending else model.id > id)
+        nulls = nulls.order_by(direction(model.id)).limit(page_size + 1 - len(items))
+        items += db.session.execute(nulls).scalars().all()
+
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, column.key), last.id)
+    return items, next_cursor
+
+
+def keyset_page(model, sort=None, order='asc', after=None, page_size=PAGE_SIZE):
+    """One page of `model` rows sorted by one of its LIST_SORTS keys.
+
+    Unknown sort keys fall back to the default; raises BadCursor for a
+    cursor that cannot be decoded."""
+    sorts = LIST_SORTS[model]
+    if sort not in sorts:
+        sort = next(iter(sorts))
+    descending = order == 'desc'
+
+    items, next_cursor = paginate(db.select(model), model, sorts[sort], descending, after, page_size)
+    return Page(items, sort, 'desc' if descending else 'asc', after, next_cursor, list(sorts))
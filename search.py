@@ -0,0 +1,311 @@
+"""In-process search structures: a typeahead index over the names and
+titles of the SWAPI models, and a cache of /search results.
+
+The searchable corpus is a few hundred short strings that only change on
+ingest, so it is held in memory as sorted arrays and looked up with bisect
+instead of querying the database on every keystroke.  Both structures are
+tied to the data version that ingest bumps, and go stale together when it
+changes."""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import OrderedDict
+
+from models import (db, DataVersion, SEARCH_COLUMNS, SEARCH_LIMIT, search_elements, fuzzy_search_elements)
+
+# Seconds a process trusts the data version it last read
+VERSION_CHECK_INTERVAL = float(os.environ.get('SEARCH_VERSION_CHECK_INTERVAL', 2))
+
+# Bounds of the /search result cache
+CACHE_ENTRIES = int(os.environ.get('SEARCH_CACHE_ENTRIES', 1024))
+CACHE_BYTES = int(os.environ.get('SEARCH_CACHE_BYTES', 4 * 1024 * 1024))
+CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', 300))
+
+# Ranks, best first
+EXACT, PREFIX, SUBSTRING = range(3)
+
+
+def fold(text):
+    """Case-fold `text` and strip its accents, so "Padmé" matches "padme" """
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).strip()
+
+
+class SearchIndex:
+    """Immutable typeahead index over (group, id, label) entries.
+
+    Every word of every folded label, plus the whole folded label, is kept in
+    one sorted array so that all keys starting with a query sit in a single
+    bisect range.  Matches rank exact > word prefix > substring, then shorter
+    labels first."""
+
+    def __init__(self, entries=(), version=None):
+        self.entries = list(entries)
+        self.version = version
+        self.folded = [fold(label) for _, _, label in self.entries]
+
+        keys = sorted({(word, i) for i, name in enumerate(self.folded) for word in name.split() + [name]})
+        self.keys = [word for word, _ in keys]
+        self.positions = [i for _, i in keys]
+
+    @classmethod
+    def from_db(cls):
+        """Build an index from the SWAPI tables"""
+        version = data_version(refresh=True)
+        entries = []
+        for group, (model, _, field) in SEARCH_COLUMNS.items():
+            label = getattr(model, field)
+            rows = db.session.execute(db.select(model.id, label).where(label.isnot(None)))
+            entries.extend((group, id, name) for id, name in rows)
+        return cls(entries, version)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def document(self):
+        """(JSON body, ETag) of the compact index served to browsers: each
+        entry is [group number, id, label], groups listed once with their
+        result type and field"""
+        if not hasattr(self, '_document'):
+            groups = list(SEARCH_COLUMNS)
+            body = json.dumps({
+                'version': self.version,
+                'groups': [[group, SEARCH_COLUMNS[group][1], SEARCH_COLUMNS[group][2]] for group in groups],
+                'entries': [[groups.index(group), id, label] for group, id, label in self.entries],
+            }, separators=(',', ':'), ensure_ascii=False)
+            self._document = body, hashlib.sha1(body.encode('utf-8')).hexdigest()
+        return self._document
+
+    def matches(self, query):
+        """{entry position: rank} of every entry matching `query`"""
+        query = fold(query)
+        ranks = {}
+
+        start = bisect_left(self.keys, query)
+        end = bisect_left(self.keys, query + '\U0010ffff', start)
+        for i in self.positions[start:end]:
+            ranks[i] = EXACT if self.folded[i] == query else PREFIX
+
+        for i, name in enumerate(self.folded):
+            if i not in ranks and query in name:
+                ranks[i] = SUBSTRING
+
+        return ranks
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Best `limit` matches per group, shaped like search_elements()"""
+        ranks = self.matches(query)
+        ranked = sorted(ranks, key=lambda i: (ranks[i], len(self.folded[i]), self.folded[i]))
+
+        results = {group: [] for group in SEARCH_COLUMNS}
+        for i in ranked:
+            group, id, label = self.entries[i]
+            if len(results[group]) < limit:
+                _, type_, field = SEARCH_COLUMNS[group]
+                results[group].append({field: label, 'type': type_, 'id': id})
+        return results
+
+
+def normalize_query(search_query):
+    """Cache key form of a query: trimmed, lower-cased, single-spaced"""
+    return ' '.join(search_query.split()).lower()
+
+
+_version = None
+_version_checked = 0.0
+_version_lock = threading.Lock()
+
+
+def data_version(refresh=False):
+    """The SWAPI data version, read from the database at most every
+    VERSION_CHECK_INTERVAL seconds unless `refresh` is given"""
+    global _version, _version_checked
+    now = time.monotonic()
+    with _version_lock:
+        if not refresh and _version is not None and now - _version_checked < VERSION_CHECK_INTERVAL:
+            return _version
+
+    version = db.session.execute(db.select(DataVersion.version).where(DataVersion.id == 1)).scalar() or 0
+    with _version_lock:
+        _version, _version_checked = version, now
+    return version
+
+
+class SearchCache:
+    """LRU cache of search results with a TTL.
+
+    Bounded by `max_entries` and by `max_bytes`, measured as the JSON size
+    of the cached results.  The cache belongs to one data version: looking
+    up a newer one empties it.  `counters` counts hits, misses, evictions
+    (for space), expirations and invalidations."""
+
+    def __init__(self, max_entries=CACHE_ENTRIES, max_bytes=CACHE_BYTES, ttl=CACHE_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.version = None
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self.entries:
+                self.counters['invalidations'] += 1
+            self.entries.clear()
+            self.bytes = 0
+            self.version = version
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key, version):
+        """The cached value for `key`, or None"""
+        with self.lock:
+            self._check_version(version)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            expires, _, value = entry
+            if self.clock() >= expires:
+                self._remove(key)
+                self.counters['expired'] += 1
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return value
+
+    def put(self, key, version, value):
+        size = len(json.dumps(value))
+        with self.lock:
+            self._check_version(version)
+            if size > self.max_bytes:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (self.clock() + self.ttl, size, value)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def get_or_compute(self, key, version, compute):
+        value = self.get(key, version)
+        if value is None:
+            value = compute()
+            self.put(key, version, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.bytes, version=self.version)
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one.
+
+    The first caller for a key runs the function; callers arriving while it
+    runs wait for it and share its result, or its exception.  `counters`
+    counts the calls that ran and the ones that were collapsed."""
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.counters = {'executed': 0, 'collapsed': 0}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+                self.counters['executed'] += 1
+            else:
+                self.counters['collapsed'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, in_flight=len(self.calls))
+
+
+search_cache = SearchCache()
+search_flights = SingleFlight()
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def search_index():
+    """The process's typeahead index, rebuilt when the data version moves on"""
+    global _index
+    version = data_version()
+    if _index is None or _index.version != version:
+        with _index_lock:
+            if _index is None or _index.version != version:
+                _index = SearchIndex.from_db()
+    return _index
+
+
+def rebuild_search_index():
+    """Replace the typeahead index with one built from the current tables"""
+    global _index
+    index = SearchIndex.from_db()
+    with _index_lock:
+        _index = index
+    return index
+
+
+def run_search(search_query, backend='index'):
+    """Answer a /search query, through the result cache.  Identical queries
+    that miss the cache at the same time share one search.
+
+    `backend` is 'index' for the in-memory typeahead index, 'trigram' for
+    the pg_trgm fuzzy search or 'db' for the plain SQL search."""
+    query = normalize_query(search_query)
+
+    def compute():
+        if backend == 'index':
+            return search_index().search(query)
+        if backend == 'trigram':
+            return fuzzy_search_elements(query)
+        return search_elements(query)
+
+    version = data_version()
+    key = (backend, query)
+    return search_cache.get_or_compute(key, version, lambda: search_flights.do(key + (version,), compute))
@@ -0,0 +1,191 @@
+"""Seed packs: the SWAPI tables exported to one compressed file that a new
+database can be loaded from in one go.
+
+A pack is a zip archive holding a manifest.json and one CSV file per table.
+On PostgreSQL both directions stream through COPY; other engines fall back
+to plain SELECTs and executemany inserts."""
+
+import csv
+import io
+import json
+import time
+import zipfile
+from datetime import date
+
+from fetch import reset_id_sequences, refresh_search_vectors, bump_data_version
+from models import (db, Person, Film, Starship, Vehicle, Species, Planet, people_films, species_people,
+                    people_starships, people_vehicles, films_species, films_starships, films_vehicles,
+                    films_planets)
+
+SEED_FORMAT = 1
+
+# Marker for NULL in the CSV files, so NULL and '' survive the round trip
+NULL = '\\N'
+
+# Tables in load order: planets first for the homeworld foreign keys, then the
+# other entities, then the association tables
+SEED_TABLES = [
+    Planet.__table__, Person.__table__, Film.__table__, Species.__table__, Starship.__table__,
+    Vehicle.__table__, people_films, species_people, people_starships, people_vehicles, films_species,
+    films_starships, films_vehicles, films_planets,
+]
+
+BATCH_SIZE = 1000
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def raw_cursor():
+    """DBAPI cursor on the connection the session is using"""
+    return db.session.connection().connection.cursor()
+
+
+def quoted_columns(columns, dialect):
+    """Comma separated column names, quoted where the dialect needs it (MGLT)"""
+    return ', '.join(dialect.identifier_preparer.quote(name) for name in columns)
+
+
+def copy_out_sql(table, columns, dialect=None):
+    """COPY ... TO STDOUT statement exporting `columns` of `table` as CSV"""
+    dialect = dialect or db.engine.dialect
+    names = quoted_columns(columns, dialect)
+    return (f"COPY (SELECT {names} FROM {dialect.identifier_preparer.format_table(table)} ORDER BY {names}) "
+            f"TO STDOUT WITH (FORMAT csv, HEADER, NULL '{NULL}')")
+
+
+def copy_in_sql(table, columns, dialect=None):
+    """COPY ... FROM STDIN statement loading `columns` of `table` from CSV"""
+    dialect = dialect or db.engine.dialect
+    return (f"COPY {dialect.identifier_preparer.format_table(table)} ({quoted_columns(columns, dialect)}) "
+            f"FROM STDIN WITH (FORMAT csv, HEADER, NULL '{NULL}')")
+
+
+def export_seed(path):
+    """Write every SWAPI table to a seed pack at `path`.
+
+    Returns the row count per table."""
+    counts = {}
+    schema = {}
+
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for table in SEED_TABLES:
+            columns = [column.name for column in table.columns]
+            with archive.open(f'{table.name}.csv', 'w') as f:
+                if is_postgres():
+                    cursor = raw_cursor()
+                    cursor.copy_expert(copy_out_sql(table, columns), f)
+                    counts[table.name] = cursor.rowcount
+                else:
+                    counts[table.name] = write_csv(f, table, columns)
+            schema[table.name] = columns
+
+        manifest = {
+            'format': SEED_FORMAT,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'tables': schema,
+            'rows': counts,
+        }
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+    db.session.rollback()
+    return counts
+
+
+def write_csv(f, table, columns):
+    """Write a table as CSV without COPY"""
+    out = io.TextIOWrapper(f, encoding='utf-8', newline='')
+    writer = csv.writer(out)
+    writer.writerow(columns)
+
+    count = 0
+    rows = db.session.execute(db.select(*table.columns).order_by(*table.columns))
+    for row in rows:
+        writer.writerow([NULL if value is None else value for value in row])
+        count += 1
+
+    out.flush()
+    out.detach()
+    return count
+
+
+def load_seed(path):
+    """Load a seed pack into empty SWAPI tables.
+
+    Everything is loaded in one transaction.  Returns the row count per
+    table; raises ValueError if the pack does not fit this database."""
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read('manifest.json'))
+        if manifest.get('format') != SEED_FORMAT:
+            raise ValueError(f"Unsupported seed pack format {manifest.get('format')}")
+
+        tables = {table.name: table for table in SEED_TABLES}
+        for name, columns in manifest['tables'].items():
+            if name not in tables:
+                raise ValueError(f'Seed pack has an unknown table: {name}')
+            unknown = set(columns) - set(tables[name].columns.keys())
+            if unknown:
+                raise ValueError(f'Seed pack columns not in {name}: {sorted(unknown)}')
+
+        for table in SEED_TABLES:
+            if db.session.execute(db.select(db.func.count()).select_from(table)).scalar():
+                raise ValueError(f'Table {table.name} is not empty')
+
+        try:
+            for table in SEED_TABLES:
+                if table.name not in manifest['tables']:
+                    continue
+                columns = manifest['tables'][table.name]
+                with archive.open(f'{table.name}.csv') as f:
+                    if is_postgres():
+                        raw_cursor().copy_expert(copy_in_sql(table, columns), f)
+                    else:
+                        insert_csv(f, table, columns)
+
+            bump_data_version()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    reset_id_sequences()
+    refresh_search_vectors()
+
+    return manifest['rows']
+
+
+def insert_csv(f, table, columns):
+    """Insert the rows of a CSV file with executemany, in batches"""
+    reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8', newline=''))
+    next(reader)
+    types = [python_type(table.columns[name]) for name in columns]
+
+    batch = []
+    for values in reader:
+        batch.append({name: parse_value(value, type_) for name, value, type_ in zip(columns, values, types)})
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+
+
+def python_type(column):
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return str
+
+
+def parse_value(value, type_):
+    """Turn one CSV field back into a python value"""
+    if value == NULL:
+        return None
+    if type_ is date:
+        return date.fromisoformat(value)
+    if type_ is bool:
+        return value in ('t', 'true', 'True', '1')
+    if type_ in (int, float):
+        return type_(value)
+    return value
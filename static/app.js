@@ -6,67 +6,173 @@ document.addEventListener("DOMContentLoaded", function () {
 		"search-results-dropdown"
 	);
 
-	searchForm.addEventListener("input", function (event) {
-		event.preventDefault();
-		const query = searchInput.value.trim();
+	// Result groups in display order: [group, url path, label field, type name]
+	const groups = [
+		["people", "characters", "name", "Person"],
+		["films", "films", "title", "Film"],
+		["starships", "starships", "name", "Starship"],
+		["vehicles", "vehicles", "name", "Vehicle"],
+		["planets", "planets", "name", "Planet"],
+		["species", "species", "name", "Species"],
+	];
+	const resultLimit = 10;
+	const debounceDelay = 150;
 
-		if (query.length === 0) {
-			searchResultsDropdown.style.display = "none";
-			searchResultsDropdown.innerHTML = "";
-			return;
-		}
+	// Typeahead against a copy of the search index held in the browser, when
+	// the server publishes one (data-index-url on the form)
+	const indexUrl = searchForm.dataset.indexUrl;
+	let localIndex = null;
+	let indexRequest = null;
 
-		fetch(`/search?query=${query}`)
-			.then((response) => response.json())
-			.then((data) => {
-				searchResultsDropdown.innerHTML = "";
-				let results = [];
+	function fold(text) {
+		return text
+			.normalize("NFKD")
+			.replace(/[\u0300-\u036f]/g, "")
+			.toLowerCase()
+			.trim();
+	}
 
-				data.people.forEach((person) => {
-					results.push(
-						`<li class="dropdown-item"><a class="dropdown-list-item" href="/characters/${person.id}">${person.name} (Person)</a></li>`
-					);
-				});
+	function escapeHtml(text) {
+		const div = document.createElement("div");
+		div.textContent = text;
+		return div.innerHTML;
+	}
 
-				data.films.forEach((film) => {
-					results.push(
-						`<li class="dropdown-item"><a class="dropdown-list-item" href="/films/${film.id}">${film.title} (Film)</a></li>`
-					);
+	function loadIndex() {
+		if (!indexUrl || indexRequest) {
+			return indexRequest;
+		}
+		// The browser revalidates with the ETag and reuses its cached copy
+		indexRequest = fetch(indexUrl, { cache: "no-cache" })
+			.then((response) => {
+				if (!response.ok) {
+					throw new Error(`Search index: ${response.status}`);
+				}
+				return response.json();
+			})
+			.then((doc) => {
+				localIndex = doc.entries.map(([group, id, label]) => {
+					const [name, type, field] = doc.groups[group];
+					return { name, type, field, id, label, folded: fold(label) };
 				});
+				return localIndex;
+			})
+			.catch((error) => {
+				console.error("Error:", error);
+				indexRequest = null;
+			});
+		return indexRequest;
+	}
 
-				data.starships.forEach((starship) => {
-					results.push(
-						`<li class="dropdown-item"><a class="dropdown-list-item" href="/starships/${starship.id}">${starship.name} (Starship)</a></li>`
-					);
-				});
+	// Same ranking as the server: exact, then word prefix, then substring
+	function rank(entry, query) {
+		if (entry.folded === query) {
+			return 0;
+		}
+		if (entry.folded.startsWith(query) || entry.folded.split(/\s+/).some((word) => word.startsWith(query))) {
+			return 1;
+		}
+		return entry.folded.includes(query) ? 2 : -1;
+	}
 
-				data.vehicles.forEach((vehicle) => {
-					results.push(
-						`<li class="dropdown-item"><a class="dropdown-list-item" href="/vehicles/${vehicle.id}">${vehicle.name} (Vehicle)</a></li>`
-					);
-				});
+	function searchLocal(query) {
+		const folded = fold(query);
+		const matches = [];
+		localIndex.forEach((entry) => {
+			const entryRank = rank(entry, folded);
+			if (entryRank >= 0) {
+				matches.push([entryRank, entry]);
+			}
+		});
+		matches.sort(
+			([rankA, a], [rankB, b]) =>
+				rankA - rankB ||
+				a.folded.length - b.folded.length ||
+				(a.folded < b.folded ? -1 : a.folded > b.folded ? 1 : 0)
+		);
 
-				data.planets.forEach((planet) => {
-					results.push(
-						`<li class="dropdown-item"><a class="dropdown-list-item" href="/planets/${planet.id}">${planet.name} (Planet)</a></li>`
-					);
-				});
+		const data = {};
+		groups.forEach(([group]) => (data[group] = []));
+		matches.forEach(([, entry]) => {
+			if (data[entry.name].length < resultLimit) {
+				data[entry.name].push({ [entry.field]: entry.label, type: entry.type, id: entry.id });
+			}
+		});
+		return data;
+	}
+
+	function showResults(data) {
+		const results = [];
+		groups.forEach(([group, path, field, typeName]) => {
+			(data[group] || []).forEach((item) => {
+				results.push(
+					`<li class="dropdown-item"><a class="dropdown-list-item" href="/${path}/${item.id}">${escapeHtml(item[field])} (${typeName})</a></li>`
+				);
+			});
+		});
 
-				data.species.forEach((species) => {
-					results.push(
-						`<li class="dropdown-item"><a class="dropdown-list-item" href="/species/${species.id}">${species.name} (Species)</a></li>`
-					);
+		searchResultsDropdown.innerHTML = results.join("");
+		searchResultsDropdown.style.display = results.length ? "block" : "none";
+	}
+
+	function hideResults() {
+		searchResultsDropdown.style.display = "none";
+		searchResultsDropdown.innerHTML = "";
+	}
+
+	// Server-side search: debounced, URL-encoded, and only the latest
+	// request is allowed to paint
+	let debounceTimer = null;
+	let pendingRequest = null;
+
+	function searchServer(query) {
+		debounceTimer = setTimeout(function () {
+			const controller = new AbortController();
+			pendingRequest = controller;
+
+			fetch(`/search?query=${encodeURIComponent(query)}`, { signal: controller.signal })
+				.then((response) => response.json())
+				.then((data) => {
+					if (pendingRequest === controller) {
+						showResults(data);
+					}
+				})
+				.catch((error) => {
+					if (error.name === "AbortError") {
+						return;
+					}
+					console.error("Error:", error);
+					searchResultsDropdown.style.display = "none";
 				});
+		}, debounceDelay);
+	}
 
-				searchResultsDropdown.innerHTML = results.join("");
-				searchResultsDropdown.style.display = results.length
-					? "block"
-					: "none";
-			})
-			.catch((error) => {
-				console.error("Error:", error);
-				searchResultsDropdown.style.display = "none";
-			});
+	function cancelServerSearch() {
+		clearTimeout(debounceTimer);
+		if (pendingRequest) {
+			pendingRequest.abort();
+			pendingRequest = null;
+		}
+	}
+
+	searchInput.addEventListener("focus", loadIndex);
+
+	searchForm.addEventListener("input", function (event) {
+		event.preventDefault();
+		const query = searchInput.value.trim();
+
+		cancelServerSearch();
+		if (query.length === 0) {
+			hideResults();
+			return;
+		}
+
+		if (localIndex) {
+			showResults(searchLocal(query));
+		} else {
+			loadIndex();
+			searchServer(query);
+		}
 	});
 	document.addEventListener("click", function (event) {
 		if (!searchForm.contains(event.target)) {
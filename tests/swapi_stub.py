@@ -0,0 +1,118 @@
+"""Local stand-in for SWAPI that serves the recorded pages in fixtures/swapi.json"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'swapi.json')
+
+
+def load_fixture():
+    """Load the recorded SWAPI records, keyed by resource name"""
+    with open(FIXTURE_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class SwapiStub:
+    """Serve recorded SWAPI records over HTTP, paginated like the real API.
+
+    Use as a context manager; `base_url` points at the `/api/` root and
+    `requests_served` counts every page handed out.  Pages carry an ETag and
+    conditional requests for an unchanged page get a 304.
+
+    `latency` delays every response, and the first `throttle` requests are
+    answered with a 429 carrying `retry_after` as the Retry-After header."""
+
+    def __init__(self, data=None, page_size=2, latency=0, throttle=0, retry_after='0'):
+        self.data = data if data is not None else load_fixture()
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.requests_served = 0
+        self.not_modified = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/api/'
+
+    def page(self, resource, page):
+        """Build the JSON body SWAPI would return for one page"""
+        items = self.data[resource]
+        start = (page - 1) * self.page_size
+        results = items[start:start + self.page_size]
+        last_page = max(1, -(-len(items) // self.page_size))
+
+        return {
+            'count': len(items),
+            'next': f'{self.base_url}{resource}/?page={page + 1}' if page < last_page else None,
+            'previous': f'{self.base_url}{resource}/?page={page - 1}' if page > 1 else None,
+            'results': results,
+        }
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                parts = [p for p in parsed.path.split('/') if p]
+                page = int(parse_qs(parsed.query).get('page', ['1'])[0])
+
+                if len(parts) != 2 or parts[0] != 'api' or parts[1] not in stub.data:
+                    self.send_error(404)
+                    return
+
+                time.sleep(stub.latency)
+                with stub.lock:
+                    throttle = stub.throttled < stub.throttle
+                    if throttle:
+                        stub.throttled += 1
+                if throttle:
+                    self.send_response(429)
+                    self.send_header('Retry-After', stub.retry_after)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body = json.dumps(stub.page(parts[1], page)).encode('utf-8')
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                with stub.lock:
+                    stub.requests_served += 1
+
+                if self.headers.get('If-None-Match') == etag:
+                    with stub.lock:
+                        stub.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
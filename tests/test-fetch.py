@@ -0,0 +1,485 @@
+import copy
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+import requests
+from sqlalchemy import event
+from app import app, db
+import fetch
+from fetch import (RESOURCES, fetch_resources, parse_number, parse_range, iter_pages, fetch_all_data, sync_data, record_snapshot,
+                   SnapshotSource, HttpSource, FetchScheduler, stream_pages, StageStats, ingest_lock,
+                   IngestLocked)
+from models import (User, Comment, Person, Film, Planet, Species, Starship, Vehicle, people_films,
+                    SwapiRecord, SyncCheckpoint, DataVersion)
+from tests.swapi_stub import SwapiStub, load_fixture
+
+
+class FetchResourcesTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """Start a local stand-in for SWAPI"""
+        cls.fixture = load_fixture()
+        cls.stub = SwapiStub(page_size=2).__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the stand-in server"""
+        cls.stub.__exit__(None, None, None)
+
+    def test_fetch_resources_gets_every_page(self):
+        """Test that the concurrent fetch returns every record in page order"""
+        pages = fetch_resources(source=self.stub.base_url, concurrency=4)
+
+        self.assertEqual(set(pages), set(RESOURCES))
+        for resource in RESOURCES:
+            urls = [item['url'] for page in pages[resource] for item in page.results]
+            self.assertEqual(urls, [item['url'] for item in self.fixture[resource]])
+
+    def test_fetch_resources_matches_sequential_walk(self):
+        """Test that the concurrent fetch sees the same pages as following `next`"""
+        pages = fetch_resources(resources=['people'], source=self.stub.base_url, concurrency=2)
+        sequential = list(iter_pages('people', source=self.stub.base_url))
+
+        self.assertEqual([page.results for page in pages['people']], sequential)
+        self.assertEqual(len(sequential), 3)
+
+    def test_http_source_closes_only_its_own_session(self):
+        """Test that a source closes the session it made, not one it was given"""
+        with mock.patch('requests.Session.close') as close:
+            list(stream_pages(source=self.stub.base_url, concurrency=2))
+            self.assertEqual(close.call_count, 1)
+
+            session = requests.Session()
+            list(stream_pages(source=HttpSource(self.stub.base_url, session=session), concurrency=2))
+            HttpSource(self.stub.base_url, session=session).close()
+            self.assertEqual(close.call_count, 1)
+
+    def test_stream_pages_only_fetches_a_window_ahead(self):
+        """Test that an idle consumer holds back the fetching"""
+        with SwapiStub(page_size=1) as stub:
+            pages = stream_pages(source=stub.base_url, concurrency=2)
+            next(pages)
+            time.sleep(0.2)
+            fetched = stub.requests_served
+
+            rest = list(pages)
+
+        # The six first pages plus a window of two
+        self.assertLessEqual(fetched, len(RESOURCES) + 2)
+        self.assertEqual(len(rest) + 1, sum(len(items) for items in self.fixture.values()))
+
+
+class FetchSchedulerTests(unittest.TestCase):
+    def test_throttled_requests_are_retried(self):
+        """Test that 429s are retried and shrink the concurrency limit"""
+        scheduler = FetchScheduler(max_concurrency=8, backoff=0.01)
+        with SwapiStub(throttle=3) as stub:
+            pages = fetch_resources(source=HttpSource(stub.base_url, 8, scheduler=scheduler), concurrency=8)
+
+        self.assertEqual(sum(len(page.results) for p in pages.values() for page in p), 16)
+        self.assertEqual(scheduler.counters['throttled'], 3)
+        self.assertEqual(scheduler.counters['retries'], 3)
+        self.assertEqual(scheduler.counters['requests'], 12)
+        self.assertGreater(scheduler.counters['bytes'], 0)
+        self.assertLess(scheduler.limit, 8)
+
+    def test_retry_after_is_honoured(self):
+        """Test that a retry waits at least as long as Retry-After asks"""
+        scheduler = FetchScheduler(backoff=0.01)
+        with SwapiStub(throttle=1, retry_after='1') as stub:
+            start = time.perf_counter()
+            list(iter_pages('films', source=HttpSource(stub.base_url, scheduler=scheduler)))
+
+        self.assertGreaterEqual(time.perf_counter() - start, 1)
+
+    def test_bad_retry_after_falls_back_to_backoff(self):
+        """Test that an unparseable Retry-After is ignored and a huge one is capped"""
+        for retry_after in ('soon', 'Sun, 32 Foo 2026 99:00:00', '86400'):
+            scheduler = FetchScheduler(backoff=0.01, max_retry_after=0.2)
+            with SwapiStub(throttle=1, retry_after=retry_after) as stub:
+                start = time.perf_counter()
+                list(iter_pages('films', source=HttpSource(stub.base_url, scheduler=scheduler)))
+
+            self.assertLess(time.perf_counter() - start, 1, retry_after)
+            self.assertEqual(scheduler.counters['retries'], 1, retry_after)
+
+    def test_gives_up_after_retries(self):
+        """Test that a request still throttled after every retry fails"""
+        scheduler = FetchScheduler(retries=2, backoff=0.01)
+        with SwapiStub(throttle=10) as stub:
+            with self.assertRaises(requests.HTTPError):
+                list(iter_pages('films', source=HttpSource(stub.base_url, scheduler=scheduler)))
+
+        self.assertEqual(scheduler.counters['requests'], 3)
+
+    def test_timeouts_are_retried(self):
+        """Test that a request slower than the timeout counts as an error"""
+        scheduler = FetchScheduler(timeout=0.1, retries=1, backoff=0.01)
+        with SwapiStub(latency=0.3) as stub:
+            with self.assertRaises(requests.Timeout):
+                list(iter_pages('films', source=HttpSource(stub.base_url, scheduler=scheduler)))
+
+        self.assertEqual(scheduler.counters['errors'], 2)
+
+    def test_limit_adapts_to_latency(self):
+        """Test that slow responses halve the limit and fast ones grow it back"""
+        scheduler = FetchScheduler(max_concurrency=8, slow_after=0.05)
+        with SwapiStub(latency=0.1) as stub:
+            list(iter_pages('people', source=HttpSource(stub.base_url, scheduler=scheduler)))
+        self.assertEqual(scheduler.limit, 1)
+
+        with SwapiStub() as stub:
+            list(iter_pages('people', source=HttpSource(stub.base_url, scheduler=scheduler)))
+        self.assertEqual(scheduler.limit, 3)
+
+
+
+class FetchAllDataTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """Start a local stand-in for SWAPI"""
+        app.config['TESTING'] = True
+        cls.stub = SwapiStub(page_size=2).__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the stand-in server"""
+        cls.stub.__exit__(None, None, None)
+
+    def setUp(self):
+        """Start each test with empty tables"""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        """Remove session and drop all tables"""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_fetch_all_data_stores_every_resource(self):
+        """Test that every record is stored under its SWAPI id"""
+        with app.app_context():
+            loader = fetch_all_data(source=self.stub.base_url, batch_size=4)
+
+            self.assertEqual(Planet.query.count(), 3)
+            self.assertEqual(Person.query.count(), 5)
+            self.assertEqual(Film.query.count(), 2)
+            self.assertEqual(Species.query.count(), 2)
+            self.assertEqual(Starship.query.count(), 2)
+            self.assertEqual(Vehicle.query.count(), 2)
+            self.assertEqual(db.session.get(Person, 35).name, 'Padmé Amidala')
+            self.assertEqual(db.session.get(Person, 35).homeworld.name, 'Naboo')
+            self.assertGreater(loader.batches, 1)
+
+    def test_fetch_all_data_parses_numeric_columns(self):
+        """Test that numeric fields are stored parsed, with NULL for unknown"""
+        with app.app_context():
+            fetch_all_data(source=self.stub.base_url)
+
+            tallest = Person.query.order_by(Person.height_num.desc()).first()
+            self.assertEqual(tallest.name, 'Darth Vader')
+            self.assertEqual(tallest.height_num, 202)
+            self.assertIsNone(db.session.get(Starship, 13).cost_in_credits_num)
+            self.assertEqual(db.session.get(Vehicle, 4).crew_min, 46)
+            self.assertEqual([p.name for p in Planet.query.filter(Planet.population_num > 1e9)
+                              .order_by(Planet.population_num)], ['Alderaan', 'Naboo'])
+            self.assertIsNone(db.session.get(Species, 2).average_lifespan_num)
+
+    def test_parse_number_and_range(self):
+        """Test the parsing of SWAPI's numeric strings"""
+        self.assertEqual(parse_number('1,358'), 1358)
+        self.assertEqual(parse_number('1000km'), 1000)
+        self.assertEqual(parse_number('0.5'), 0.5)
+        self.assertIsNone(parse_number('unknown'))
+        self.assertIsNone(parse_number('n/a'))
+        self.assertIsNone(parse_number('30-165'))
+        self.assertEqual(parse_range('30-165'), (30, 165))
+        self.assertEqual(parse_range('5,000'), (5000, 5000))
+        self.assertEqual(parse_range('unknown'), (None, None))
+
+    def test_fetch_all_data_reports_stage_timings(self):
+        """Test that every pipeline stage is metered"""
+        stages = StageStats()
+        with app.app_context():
+            loader = fetch_all_data(source=self.stub.base_url, stages=stages)
+
+        summary = stages.summary()
+        self.assertEqual(list(summary), ['fetch', 'parse', 'normalize', 'load'])
+        self.assertEqual(summary['fetch'][0], 9)
+        self.assertEqual(summary['parse'][0], 16)
+        self.assertEqual(summary['normalize'][0], 16)
+        self.assertEqual(summary['load'][0], loader.rows)
+
+    def test_fetch_all_data_stores_links(self):
+        """Test that relationships are written to the association tables"""
+        with app.app_context():
+            fetch_all_data(source=self.stub.base_url)
+
+            film = db.session.get(Film, 1)
+            self.assertEqual(sorted(p.name for p in film.characters),
+                             ['C-3PO', 'Darth Vader', 'Leia Organa', 'Luke Skywalker'])
+            self.assertEqual([s.name for s in db.session.get(Starship, 13).pilots], ['Darth Vader'])
+            self.assertEqual(db.session.query(people_films).count(), 6)
+
+    def test_fetch_all_data_keeps_links_listed_on_one_side(self):
+        """Test that a link only listed on a record loaded before its target is kept"""
+        data = copy.deepcopy(load_fixture())
+        new_hope = data['films'][0]
+        new_hope['characters'] = [url for url in new_hope['characters'] if not url.endswith('/people/1/')]
+
+        with SwapiStub(data=data) as stub, app.app_context():
+            fetch_all_data(source=stub.base_url)
+
+            luke = db.session.get(Person, 1)
+            self.assertEqual([film.title for film in luke.films], ['A New Hope'])
+
+    def test_fetch_all_data_does_not_select_per_link(self):
+        """Test that storing the data issues no SELECTs"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                fetch_all_data(source=self.stub.base_url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual([s for s in statements if s.lstrip().upper().startswith('SELECT')], [])
+
+
+
+class SyncDataTests(unittest.TestCase):
+    def setUp(self):
+        """Start each test with empty tables and a fresh stand-in server"""
+        app.config['TESTING'] = True
+        self.data = copy.deepcopy(load_fixture())
+        self.stub = SwapiStub(data=self.data).__enter__()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        """Stop the server, remove session and drop all tables"""
+        self.stub.__exit__(None, None, None)
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_sync_data_loads_everything_the_first_time(self):
+        """Test that a first sync inserts every record and link"""
+        with app.app_context():
+            stats = sync_data(source=self.stub.base_url)
+
+            self.assertEqual(stats['inserted'], 16)
+            self.assertEqual(stats['updated'], 0)
+            self.assertEqual(Person.query.count(), 5)
+            self.assertEqual(db.session.query(people_films).count(), 6)
+
+    def test_sync_data_skips_unchanged_pages(self):
+        """Test that a repeat sync gets 304s and writes nothing"""
+        with app.app_context():
+            sync_data(source=self.stub.base_url)
+            version = db.session.get(DataVersion, 1).version
+            stats = sync_data(source=self.stub.base_url)
+
+            self.assertEqual(db.session.get(DataVersion, 1).version, version)
+            self.assertEqual(self.stub.not_modified, 9)
+            self.assertEqual(stats['inserted'] + stats['updated'], 0)
+            self.assertEqual(stats['unchanged'], 16)
+            self.assertEqual(stats['links_added'] + stats['links_removed'], 0)
+
+    def test_sync_data_applies_changes_and_keeps_comments(self):
+        """Test that changed records and links are applied without losing comments"""
+        with app.app_context():
+            sync_data(source=self.stub.base_url)
+            user = User.signup(username='testuser', email='test@example.com', password='password')
+            db.session.add(Comment(text='Great ship', user_id=user.id, target_type='starship', target_id=12))
+            db.session.commit()
+
+            x_wing = self.data['starships'][0]
+            x_wing['name'] = 'X-wing Starfighter'
+            x_wing['pilots'] = []
+            x_wing['edited'] = '2024-01-01T00:00:00.000000Z'
+            luke = self.data['people'][0]
+            luke['starships'] = []
+            luke['edited'] = '2024-01-01T00:00:00.000000Z'
+
+            version = db.session.get(DataVersion, 1).version
+            stats = sync_data(source=self.stub.base_url)
+
+            self.assertEqual(db.session.get(DataVersion, 1).version, version + 1)
+            self.assertEqual(stats['updated'], 2)
+            self.assertEqual(stats['unchanged'], 14)
+            self.assertEqual(stats['links_removed'], 1)
+            starship = db.session.get(Starship, 12)
+            self.assertEqual(starship.name, 'X-wing Starfighter')
+            self.assertEqual(starship.pilots, [])
+            self.assertEqual(len(starship.comments), 1)
+
+    def test_sync_data_resumes_from_checkpoints(self):
+        """Test that an interrupted sync picks up after its last checkpoint"""
+        class FlakySource(HttpSource):
+            def fetch_page(self, resource, number, etag=None):
+                if (resource, number) == ('films', 1):
+                    raise ConnectionError('connection reset')
+                return super().fetch_page(resource, number, etag)
+
+        with app.app_context():
+            with self.assertRaises(ConnectionError):
+                sync_data(source=FlakySource(self.stub.base_url), concurrency=1, batch_size=1)
+            checkpoints = {(c.resource, c.page) for c in SyncCheckpoint.query.all()}
+            self.assertIn(('people', 3), checkpoints)
+
+            served = self.stub.requests_served
+            stats = sync_data(source=self.stub.base_url)
+
+            self.assertEqual(stats['resumed_pages'], len(checkpoints))
+            self.assertEqual(self.stub.requests_served - served, 9 - len(checkpoints))
+            self.assertEqual(Person.query.count(), 5)
+            self.assertEqual(db.session.query(people_films).count(), 6)
+            self.assertEqual(SyncCheckpoint.query.count(), 0)
+
+    def test_sync_interrupted_mid_page_refetches_the_page(self):
+        """Test that a page's ETag is not saved before all of its records are"""
+        record_digest = fetch.record_digest
+
+        def fail_on_c3po(item):
+            if item['url'].endswith('/people/2/'):
+                raise ConnectionError('connection reset')
+            return record_digest(item)
+
+        with app.app_context():
+            sync_data(source=self.stub.base_url)
+            c3po = self.data['people'][1]
+            c3po['name'] = 'C-3PO (golden)'
+            c3po['edited'] = '2024-01-01T00:00:00.000000Z'
+
+            with mock.patch('fetch.record_digest', side_effect=fail_on_c3po):
+                with self.assertRaises(ConnectionError):
+                    sync_data(source=self.stub.base_url, concurrency=1, batch_size=1)
+            sync_data(source=self.stub.base_url, resume=False)
+
+            self.assertEqual(db.session.get(Person, 2).name, 'C-3PO (golden)')
+
+    def test_resumed_sync_bumps_data_version(self):
+        """Test that a sync resuming from checkpoints marks the data changed,
+        even when the interrupted run already wrote every change"""
+        class FlakySource(HttpSource):
+            def fetch_page(self, resource, number, etag=None):
+                if (resource, number) == ('films', 1):
+                    raise ConnectionError('connection reset')
+                return super().fetch_page(resource, number, etag)
+
+        with app.app_context():
+            sync_data(source=self.stub.base_url)
+            luke = self.data['people'][0]
+            luke['name'] = 'Luke Skywalker (Jedi)'
+            luke['edited'] = '2024-01-01T00:00:00.000000Z'
+            version = db.session.get(DataVersion, 1).version
+
+            with self.assertRaises(ConnectionError):
+                sync_data(source=FlakySource(self.stub.base_url), concurrency=1, batch_size=1)
+            self.assertEqual(db.session.get(Person, 1).name, 'Luke Skywalker (Jedi)')
+            stats = sync_data(source=self.stub.base_url)
+
+            self.assertEqual(stats['inserted'] + stats['updated'], 0)
+            self.assertGreater(stats['resumed_pages'], 0)
+            self.assertEqual(db.session.get(DataVersion, 1).version, version + 1)
+
+    def test_record_moved_to_another_page_survives_a_304(self):
+        """Test that an unchanged record moving pages is replayed from its new
+        page when that page later comes back 304"""
+        with app.app_context():
+            sync_data(source=self.stub.base_url)
+            # Darth Vader moves from page 2 to page 1 unchanged
+            del self.data['people'][1]
+            sync_data(source=self.stub.base_url)
+            padme = self.data['people'][3]
+            padme['name'] = 'Padmé Naberrie'
+            padme['edited'] = '2024-01-01T00:00:00.000000Z'
+            stats = sync_data(source=self.stub.base_url)
+
+            self.assertEqual(stats['updated'], 1)
+            self.assertEqual(db.session.get(SwapiRecord, ('people', 4)).page, 1)
+            self.assertEqual(len(db.session.get(Person, 4).films), 1)
+
+    def test_ingest_lock_allows_one_sync(self):
+        """Test that a second sync is refused while one holds the lock"""
+        with app.app_context(), ingest_lock():
+            with self.assertRaises(IngestLocked):
+                with ingest_lock():
+                    pass
+
+    def test_sync_command(self):
+        """Test the flask swapi sync command"""
+        result = app.test_cli_runner().invoke(args=['swapi', 'sync', '--source', self.stub.base_url])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('people: page 3/3', result.output)
+        self.assertIn('normalize: 16 items', result.output)
+        self.assertIn('inserted 16', result.output)
+        self.assertIn('http: requests 9', result.output)
+
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        """Record a snapshot of the stand-in server"""
+        app.config['TESTING'] = True
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'swapi.zip')
+        with SwapiStub() as stub:
+            self.pages = record_snapshot(self.path, source=stub.base_url)
+            self.requests_served = stub.requests_served
+
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        """Remove the snapshot, session and all tables"""
+        self.tmpdir.cleanup()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_record_snapshot_saves_every_page(self):
+        """Test that the recorder saves each page it fetched"""
+        self.assertEqual(self.pages, {'planets': 2, 'people': 3, 'films': 1,
+                                      'species': 1, 'starships': 1, 'vehicles': 1})
+        self.assertEqual(self.requests_served, 9)
+
+    def test_fetch_all_data_replays_snapshot(self):
+        """Test that a reseed from the snapshot needs no server"""
+        with app.app_context():
+            fetch_all_data(source=self.path)
+
+            self.assertEqual(Person.query.count(), 5)
+            self.assertEqual(db.session.query(people_films).count(), 6)
+
+    def test_snapshot_source_matches_live_pages(self):
+        """Test that replayed pages are the pages that were recorded"""
+        source = SnapshotSource(self.path)
+        try:
+            replayed = list(iter_pages('people', source=source))
+        finally:
+            source.close()
+
+        with SwapiStub() as stub:
+            live = list(iter_pages('people', source=stub.base_url))
+
+        self.assertEqual(replayed, live)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,353 @@
+import threading
+import time
+import unittest
+from sqlalchemy import event
+from app import app, db
+from fetch import fetch_all_data
+from models import Film, search_elements, fuzzy_search_elements, full_text_search
+from search import SearchIndex, SearchCache, SingleFlight, fold, rebuild_search_index, search_cache, data_version
+from tests.swapi_stub import SwapiStub
+
+
+class SearchTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """Load the stand-in SWAPI data once for every search test"""
+        app.config['TESTING'] = True
+        cls.client = app.test_client()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            with SwapiStub() as stub:
+                fetch_all_data(source=stub.base_url)
+            rebuild_search_index()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Remove session and drop all tables"""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_search_route_keeps_json_shape(self):
+        """Test that /search returns every group in the shape app.js reads"""
+        response = self.client.get('/search?query=sky')
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(data), {'people', 'films', 'starships', 'vehicles', 'planets', 'species'})
+        self.assertEqual(data['people'], [{'name': 'Luke Skywalker', 'type': 'person', 'id': 1}])
+
+        data = self.client.get('/search?query=HOPE').get_json()
+        self.assertEqual(data['films'], [{'title': 'A New Hope', 'type': 'film', 'id': 1}])
+
+    def test_search_index_json(self):
+        """Test that the browser index lists every name and revalidates by ETag"""
+        response = self.client.get('/search/index.json')
+        doc = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        self.assertEqual(len(doc['entries']), 16)
+        self.assertIn(['people', 'person', 'name'], doc['groups'])
+        group = [g[0] for g in doc['groups']].index('people')
+        self.assertIn([group, 35, 'Padmé Amidala'], doc['entries'])
+
+        etag = response.headers['ETag']
+        response = self.client.get('/search/index.json', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_pages_point_browser_at_index(self):
+        """Test that the search form carries the index url"""
+        response = self.client.get('/')
+        self.assertIn(b'data-index-url="/search/index.json"', response.data)
+
+    def test_search_runs_one_statement(self):
+        """Test that a search is a single round trip"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                search_elements('a')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(len(statements), 1)
+
+    def test_search_caps_each_group(self):
+        """Test that each group returns at most `limit` results, by name"""
+        with app.app_context():
+            results = search_elements('a', limit=2)
+
+        self.assertEqual([p['name'] for p in results['people']], ['Darth Vader', 'Leia Organa'])
+        self.assertTrue(all(len(group) <= 2 for group in results.values()))
+
+    def test_search_treats_wildcards_literally(self):
+        """Test that % and _ in a query are not LIKE wildcards"""
+        with app.app_context():
+            results = search_elements('%')
+
+        self.assertEqual(sum(len(group) for group in results.values()), 0)
+
+
+    def test_fuzzy_search_tolerates_typos(self):
+        """Test that the trigram search finds names despite a typo"""
+        with app.app_context():
+            if db.engine.dialect.name != 'postgresql':
+                self.skipTest('pg_trgm needs PostgreSQL')
+            db.session.execute(db.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            results = fuzzy_search_elements('skywlker')
+            db.session.rollback()
+
+        self.assertEqual(results['people'][0], {'name': 'Luke Skywalker', 'type': 'person', 'id': 1})
+
+    def test_fuzzy_search_falls_back_without_postgres(self):
+        """Test that other databases get the plain search"""
+        with app.app_context():
+            if db.engine.dialect.name == 'postgresql':
+                self.skipTest('PostgreSQL runs the trigram search')
+            self.assertEqual(fuzzy_search_elements('sky'), search_elements('sky'))
+
+    def test_text_search_finds_descriptive_fields(self):
+        """Test that /search/text matches crawl text, models and classifications"""
+        data = self.client.get('/search/text?query=rebel').get_json()
+
+        film = data['films'][0]
+        self.assertEqual((film['title'], film['id']), ('A New Hope', 1))
+        self.assertIn('<b>Rebel</b>', film['snippet'])
+
+        with app.app_context():
+            self.assertEqual(full_text_search('incom')['starships'][0]['name'], 'X-wing')
+            self.assertEqual(full_text_search('artificial')['species'][0]['name'], 'Droid')
+
+    def test_text_search_snippets_escape_record_text(self):
+        """Test that the only markup in a snippet is the highlighting"""
+        with app.app_context():
+            film = db.session.get(Film, 1)
+            crawl = film.opening_crawl
+            film.opening_crawl = '<script>alert(1)</script> Rebel spaceships & "friends"'
+            db.session.commit()
+        try:
+            snippet = self.client.get('/search/text?query=rebel').get_json()['films'][0]['snippet']
+        finally:
+            with app.app_context():
+                db.session.get(Film, 1).opening_crawl = crawl
+                db.session.commit()
+
+        self.assertNotIn('<script>', snippet)
+        self.assertIn('&lt;script&gt;', snippet)
+        self.assertIn('<b>Rebel</b>', snippet)
+        self.assertIn('&amp; &#34;friends&#34;', snippet)
+
+    def test_text_search_ranks_names_first(self):
+        """Test that a name match outranks a match in the description"""
+        with app.app_context():
+            starships = full_text_search('x-wing')['starships']
+
+        self.assertEqual(starships[0]['name'], 'X-wing')
+        self.assertGreater(starships[0]['rank'], 0)
+
+    def test_text_search_empty_query(self):
+        """Test that an empty query matches nothing"""
+        with app.app_context():
+            results = full_text_search('  ')
+
+        self.assertEqual(sum(len(group) for group in results.values()), 0)
+
+
+class SearchIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.index = SearchIndex([
+            ('people', 1, 'Luke Skywalker'),
+            ('people', 11, 'Anakin Skywalker'),
+            ('people', 35, 'Padmé Amidala'),
+            ('starships', 12, 'X-wing'),
+            ('vehicles', 14, 'Snowspeeder'),
+            ('films', 1, 'A New Hope'),
+            ('planets', 1, 'Tatooine'),
+            ('planets', 99, 'Sky'),
+        ])
+
+    def test_fold_strips_case_and_accents(self):
+        """Test that folded names compare without case or accents"""
+        self.assertEqual(fold('Padmé Amidala'), 'padme amidala')
+        self.assertEqual(fold(' LUKE '), 'luke')
+
+    def test_accented_names_match_plain_queries(self):
+        """Test that "padme" finds "Padmé Amidala" """
+        results = self.index.search('padme')
+        self.assertEqual(results['people'], [{'name': 'Padmé Amidala', 'type': 'person', 'id': 35}])
+
+    def test_ranking(self):
+        """Test that results rank exact > word prefix > substring"""
+        ranks = self.index.matches('sky')
+        self.assertEqual(ranks[7], 0)
+        self.assertEqual(ranks[0], 1)
+        self.assertEqual(ranks[1], 1)
+
+        results = self.index.search('ee')
+        self.assertEqual(results['vehicles'][0]['name'], 'Snowspeeder')
+        self.assertEqual(self.index.matches('ee'), {4: 2})
+
+        people = self.index.search('sky')['people']
+        self.assertEqual([p['name'] for p in people], ['Luke Skywalker', 'Anakin Skywalker'])
+
+    def test_whole_name_prefix(self):
+        """Test that a query spanning words matches the start of the name"""
+        self.assertEqual(self.index.search('luke sky')['people'][0]['id'], 1)
+        self.assertEqual(self.index.search('a new h')['films'][0]['title'], 'A New Hope')
+
+    def test_top_k_limit(self):
+        """Test that each group is cut to the limit"""
+        self.assertEqual(len(self.index.search('a', limit=1)['people']), 1)
+
+    def test_index_lookup_does_not_touch_database(self):
+        """Test that the /search route answers from memory"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                app.test_client().get('/search?query=sky')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual([s for s in statements if 'people' in s], [])
+
+
+
+class SearchCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = SearchCache(max_entries=2, max_bytes=1000, ttl=10, clock=lambda: self.now)
+
+    def test_hits_and_misses(self):
+        """Test that a cached result is served until it expires"""
+        self.assertIsNone(self.cache.get('luke', 1))
+        self.cache.put('luke', 1, {'people': []})
+        self.assertEqual(self.cache.get('luke', 1), {'people': []})
+
+        self.now = 10
+        self.assertIsNone(self.cache.get('luke', 1))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+        self.assertEqual(self.cache.stats()['expired'], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        """Test that the entry count bound evicts the least recently used"""
+        self.cache.put('a', 1, 'A')
+        self.cache.put('b', 1, 'B')
+        self.cache.get('a', 1)
+        self.cache.put('c', 1, 'C')
+
+        self.assertEqual(self.cache.get('a', 1), 'A')
+        self.assertIsNone(self.cache.get('b', 1))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_size_bound(self):
+        """Test that entries are evicted to stay under the byte bound"""
+        self.cache.put('a', 1, 'x' * 600)
+        self.cache.put('b', 1, 'y' * 600)
+
+        self.assertEqual(len(self.cache), 1)
+        self.assertLessEqual(self.cache.bytes, 1000)
+        self.cache.put('c', 1, 'z' * 2000)
+        self.assertIsNone(self.cache.get('c', 1))
+
+    def test_new_data_version_invalidates(self):
+        """Test that an ingest empties the cache"""
+        self.cache.put('luke', 1, 'old')
+        self.assertIsNone(self.cache.get('luke', 2))
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+    def test_search_route_uses_cache(self):
+        """Test that repeated queries are served from the cache"""
+        with SwapiStub() as stub, app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            fetch_all_data(source=stub.base_url)
+            version = data_version(refresh=True)
+
+            client = app.test_client()
+            before = search_cache.stats()
+            client.get('/search?query=Luke')
+            data = client.get('/search?query=%20luke%20').get_json()
+            stats = client.get('/search/stats').get_json()['cache']
+
+            self.assertEqual(data['people'][0]['name'], 'Luke Skywalker')
+            self.assertEqual(stats['hits'] - before['hits'], 1)
+            self.assertEqual(stats['version'], version)
+
+            db.session.remove()
+            db.drop_all()
+
+
+
+class SingleFlightTests(unittest.TestCase):
+    def run_concurrently(self, flight, fn, callers=5):
+        """Call flight.do from several threads while `fn` is held open"""
+        results = []
+
+        def call():
+            try:
+                results.append(flight.do('luke', fn))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        while flight.stats()['collapsed'] < callers - 1:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def test_concurrent_calls_share_one_execution(self):
+        """Test that identical concurrent calls run once and share the result"""
+        def search():
+            self.calls += 1
+            self.release.wait()
+            return {'people': ['Luke Skywalker']}
+
+        flight = SingleFlight()
+        results = self.run_concurrently(flight, search)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{'people': ['Luke Skywalker']}] * 5)
+        self.assertEqual(flight.stats(), {'executed': 1, 'collapsed': 4, 'in_flight': 0})
+
+    def test_errors_are_shared(self):
+        """Test that waiters see the exception of the call they joined"""
+        def search():
+            self.release.wait()
+            raise RuntimeError('database went away')
+
+        results = self.run_concurrently(SingleFlight(), search, callers=3)
+
+        self.assertEqual([type(r) for r in results], [RuntimeError] * 3)
+
+    def test_later_calls_run_again(self):
+        """Test that nothing is remembered once a call has finished"""
+        flight = SingleFlight()
+        self.assertEqual(flight.do('luke', lambda: 1), 1)
+        self.assertEqual(flight.do('luke', lambda: 2), 2)
+        self.assertEqual(flight.stats()['executed'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from app import app, db
+from fetch import fetch_all_data
+from sqlalchemy.dialects import postgresql
+from models import Person, Film, Starship, people_films
+from seed import export_seed, load_seed, copy_out_sql, copy_in_sql
+from tests.swapi_stub import SwapiStub
+
+
+class SeedPackTests(unittest.TestCase):
+    def setUp(self):
+        """Load the stand-in SWAPI data and export it as a seed pack"""
+        app.config['TESTING'] = True
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'seed.zip')
+
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            with SwapiStub() as stub:
+                fetch_all_data(source=stub.base_url)
+            self.counts = export_seed(self.path)
+
+    def tearDown(self):
+        """Remove the pack, session and all tables"""
+        self.tmpdir.cleanup()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def reset_tables(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+    def test_export_seed_counts_rows(self):
+        """Test that the export covers every SWAPI table"""
+        self.assertEqual(len(self.counts), 14)
+        self.assertEqual(self.counts['people'], 5)
+        self.assertEqual(self.counts['people_films'], 6)
+
+    def test_load_seed_round_trip(self):
+        """Test that loading a pack restores the exported rows"""
+        with app.app_context():
+            self.reset_tables()
+            counts = load_seed(self.path)
+
+            self.assertEqual(counts, self.counts)
+            self.assertEqual(Person.query.count(), 5)
+            self.assertEqual(db.session.query(people_films).count(), 6)
+            film = db.session.get(Film, 1)
+            self.assertEqual(film.release_date.isoformat(), '1977-05-25')
+            self.assertEqual(db.session.get(Person, 35).homeworld.name, 'Naboo')
+
+    def test_load_seed_refuses_populated_tables(self):
+        """Test that a pack is not loaded over existing data"""
+        with app.app_context():
+            with self.assertRaises(ValueError):
+                load_seed(self.path)
+
+    def test_load_seed_command(self):
+        """Test the flask swapi load-seed command"""
+        with app.app_context():
+            self.reset_tables()
+
+        result = app.test_cli_runner().invoke(args=['swapi', 'load-seed', self.path])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Loaded 38 rows into 14 tables', result.output)
+
+
+    def test_copy_statements_quote_mixed_case_columns(self):
+        """Test that COPY names MGLT as the quoted identifier PostgreSQL created"""
+        columns = [column.name for column in Starship.__table__.columns]
+        copy_out = copy_out_sql(Starship.__table__, columns, postgresql.dialect())
+        copy_in = copy_in_sql(Starship.__table__, columns, postgresql.dialect())
+
+        for sql in (copy_out, copy_in):
+            self.assertIn('"MGLT", ', sql)
+            self.assertIn('"MGLT_num"', sql)
+            self.assertNotIn(' MGLT', sql)
+        self.assertTrue(copy_in.startswith('COPY starships (id, name, '))
+        self.assertIn('FROM starships ORDER BY id, name, ', copy_out)
+
+
+if __name__ == '__main__':
+    unittest.main()
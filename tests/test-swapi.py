@@ -1,7 +1,11 @@
+import re
 import unittest
+from datetime import date
+from sqlalchemy import event
 from flask_bcrypt import Bcrypt
 from app import app, db
-from models import User, Person, Film, Starship, Vehicle, Species, Planet
+from models import User, Comment, Person, Film, Starship, Vehicle, Species, Planet
+from pagination import LIST_SORTS, keyset_page, encode_cursor, BadCursor
 
 bcrypt = Bcrypt(app)
 
@@ -180,5 +184,322 @@ class SwapiRouteTests(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Tatooine', response.data)
 
+
+class DetailQueryCountTests(unittest.TestCase):
+    def setUp(self):
+        """Start each test with empty tables"""
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        """Remove session and drop all tables"""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def add_relations(self, n):
+        """Give Luke and A New Hope `n` more of every relationship and comment"""
+        with app.app_context():
+            luke = db.session.get(Person, 1) or Person(id=1, name='Luke Skywalker')
+            film = db.session.get(Film, 1) or Film(id=1, title='A New Hope')
+            luke.homeworld = luke.homeworld or Planet(name='Tatooine')
+            db.session.add_all([luke, film])
+            db.session.flush()
+            for i in range(n):
+                tag = f'{n}-{i}'
+                user = User(username=f'user{tag}', email=f'user{tag}@example.com', password='x')
+                luke.films.append(Film(title=f'Film {tag}'))
+                luke.species.append(Species(name=f'Species {tag}'))
+                luke.starships.append(Starship(name=f'Starship {tag}'))
+                luke.vehicles.append(Vehicle(name=f'Vehicle {tag}'))
+                film.characters.append(Person(name=f'Person {tag}'))
+                film.planets.append(Planet(name=f'Planet {tag}'))
+                db.session.add_all([
+                    Comment.about(luke, text='Nice', user=user),
+                    Comment.about(film, text='Nice', user=user),
+                ])
+            db.session.commit()
+
+    def count_queries(self, url):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                response = self.client.get(url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def test_detail_pages_run_a_fixed_number_of_queries(self):
+        """Test that detail pages do not lazy load per related row"""
+        self.add_relations(1)
+        person_queries = self.count_queries('/characters/1')
+        film_queries = self.count_queries('/films/1')
+
+        self.add_relations(5)
+
+        self.assertEqual(self.count_queries('/characters/1'), person_queries)
+        self.assertEqual(self.count_queries('/films/1'), film_queries)
+        self.assertLessEqual(person_queries, 6)
+        self.assertLessEqual(film_queries, 4)
+
+    def test_comments_belong_to_one_target(self):
+        """Test that a person and a film with the same id keep their own comments, best first"""
+        self.add_relations(2)
+        with app.app_context():
+            comment = db.session.get(Person, 1).comments[-1]
+            comment.upvotes = 3
+            db.session.commit()
+
+            luke, film = db.session.get(Person, 1), db.session.get(Film, 1)
+            self.assertEqual(len(luke.comments), 2)
+            self.assertEqual(len(film.comments), 2)
+            self.assertEqual({c.target_type for c in luke.comments}, {'person'})
+            self.assertEqual(luke.comments[0].id, comment.id)
+            self.assertEqual(luke.comments[0].score, 3)
+
+    def test_profile_resolves_comment_targets_in_batches(self):
+        """Test that the profile loads comment targets with one query per type"""
+        with app.app_context():
+            user = User(username='critic', email='critic@example.com', password='x')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+        with self.client.session_transaction() as session:
+            session['user_id'] = user_id
+
+        def add_comments(n):
+            with app.app_context():
+                for i in range(n):
+                    elements = [Person(name=f'Person {n}-{i}'), Film(title=f'Film {n}-{i}'),
+                                Starship(name=f'Starship {n}-{i}'), Planet(name=f'Planet {n}-{i}')]
+                    db.session.add_all(elements)
+                    db.session.flush()
+                    db.session.add_all(Comment.about(element, text='Nice', user_id=user_id) for element in elements)
+                db.session.commit()
+
+        add_comments(1)
+        queries = self.count_queries(f'/profile/{user_id}')
+        add_comments(5)
+
+        self.assertEqual(self.count_queries(f'/profile/{user_id}'), queries)
+        response = self.client.get(f'/profile/{user_id}')
+        self.assertIn(b'View Starship: Starship 5-4', response.data)
+
+
+class ListPaginationTests(unittest.TestCase):
+    def setUp(self):
+        """Add people with known, tied and unknown heights"""
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        heights = [('Yoda', 66), ('Luke Skywalker', 172), ('Han Solo', 180), ('Chewbacca', 228),
+                   ('Leia Organa', 150), ('Wedge Antilles', 170), ('Biggs Darklighter', 172),
+                   ('Arvel Crynyd', None), ('Ric Olié', None)]
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            db.session.add_all(Person(name=name, height_num=height) for name, height in heights)
+            db.session.commit()
+
+    def tearDown(self):
+        """Remove session and drop all tables"""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def walk(self, **kwargs):
+        """Names on every page, following the cursors"""
+        names, after = [], None
+        while True:
+            page = keyset_page(Person, after=after, page_size=2, **kwargs)
+            names.extend(person.name for person in page.items)
+            if not page.next_cursor:
+                return names
+            after = page.next_cursor
+
+    def test_pages_cover_every_row_once(self):
+        """Test that following cursors visits each row once, in order"""
+        with app.app_context():
+            by_name = self.walk()
+            by_height = self.walk(sort='height')
+            by_height_desc = self.walk(sort='height', order='desc')
+
+        self.assertEqual(by_name, sorted(by_name))
+        self.assertEqual(len(by_name), 9)
+        self.assertEqual(by_height, ['Yoda', 'Leia Organa', 'Wedge Antilles', 'Luke Skywalker',
+                                     'Biggs Darklighter', 'Han Solo', 'Chewbacca', 'Arvel Crynyd', 'Ric Olié'])
+        self.assertEqual(by_height_desc[:3], ['Chewbacca', 'Han Solo', 'Biggs Darklighter'])
+        self.assertEqual(by_height_desc[-2:], ['Ric Olié', 'Arvel Crynyd'])
+
+    def test_unknown_sort_falls_back_to_default(self):
+        """Test that an unknown sort key sorts by name"""
+        with app.app_context():
+            page = keyset_page(Person, sort='password')
+
+        self.assertEqual(page.sort, 'name')
+        self.assertIsNone(page.next_cursor)
+
+    def test_bad_cursor(self):
+        """Test that a mangled cursor is refused"""
+        with app.app_context():
+            with self.assertRaises(BadCursor):
+                keyset_page(Person, after='not-a-cursor')
+
+        response = self.client.get('/characters?after=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+    def test_tampered_cursor(self):
+        """Test that a cursor whose sort value does not fit the sort column is refused"""
+        cursors = [('height', ['abc', 1]), ('height', [True, 1]), ('height', [{'a': 1}, 1]),
+                   ('height', [[1, 2], 1]), ('name', [[1, 2], 1]), ('name', [5, 1]), ('name', ['Luke', '1'])]
+        for sort, cursor in cursors:
+            after = encode_cursor(*cursor)
+            with app.app_context():
+                with self.assertRaises(BadCursor, msg=cursor):
+                    keyset_page(Person, sort=sort, after=after)
+
+            response = self.client.get(f'/characters?sort={sort}&after={after}')
+            self.assertEqual(response.status_code, 400, cursor)
+
+        with app.app_context():
+            self.assertEqual(len(keyset_page(Person, sort='height', after=encode_cursor(150, 5)).items), 7)
+
+    def test_list_route_links_next_page(self):
+        """Test that a list page shows sort links and a next page link"""
+        with app.app_context():
+            first = keyset_page(Person, sort='height', page_size=1)
+
+        response = self.client.get(f'/characters?sort=height&after={first.next_cursor}')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'Yoda', response.data)
+        self.assertIn(b'Leia Organa', response.data)
+        self.assertIn(b'sort=mass', response.data)
+        self.assertIn(b'First', response.data)
+
+
+class QueryPlanTests(unittest.TestCase):
+    # Tables whose lookups must go through a key or an index
+    INDEXED_TABLES = {'comments', 'comment_votes', 'people_films', 'species_people', 'people_starships',
+                      'people_vehicles', 'films_species', 'films_starships', 'films_vehicles', 'films_planets'}
+
+    def setUp(self):
+        """Add Luke, A New Hope, their links and comments by two users"""
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            luke = Person(id=1, name='Luke Skywalker', homeworld=Planet(id=1, name='Tatooine'))
+            film = Film(id=1, title='A New Hope', characters=[luke], planets=[luke.homeworld])
+            luke.starships.append(Starship(id=12, name='X-wing'))
+            luke.vehicles.append(Vehicle(id=14, name='Snowspeeder'))
+            luke.species.append(Species(id=1, name='Human'))
+            author = User(username='author', email='author@example.com', password='x')
+            voter = User(username='voter', email='voter@example.com', password='x')
+            db.session.add_all([luke, film, author, voter])
+            db.session.flush()
+            db.session.add_all([Comment.about(luke, text='Nice', user=author),
+                                Comment.about(film, text='Nice', user=author)])
+            db.session.commit()
+            self.author_id, self.voter_id = author.id, voter.id
+
+    def tearDown(self):
+        """Remove session and drop all tables"""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def record(self, request):
+        """The SELECTs, UPDATEs and DELETEs run while making `request`, with their parameters"""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, *args):
+            if statement.split()[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+                statements.append((statement, parameters))
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                request()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+        return statements
+
+    def plans(self, statements):
+        """The query plan of each of `statements`, as a list of its steps"""
+        with app.app_context(), db.engine.connect() as conn:
+            postgres = conn.dialect.name == 'postgresql'
+            if postgres:
+                # Tables this small are cheaper to scan; ask whether an index can be used at all
+                conn.exec_driver_sql('SET enable_seqscan = off')
+            explain = 'EXPLAIN ' if postgres else 'EXPLAIN QUERY PLAN '
+            return [[str(row[-1]) for row in conn.exec_driver_sql(explain + statement, parameters)]
+                    for statement, parameters in statements]
+
+    def full_scans(self, statements):
+        """Tables of INDEXED_TABLES that the plans of `statements` read in full"""
+        scans = set()
+        for plan in self.plans(statements):
+            for step in plan:
+                words = step.replace('Seq Scan on', 'SCAN').split()
+                for i, word in enumerate(words[:-1]):
+                    table = re.sub(r'_\d+$', '', words[i + 1])
+                    if word == 'SCAN' and table in self.INDEXED_TABLES:
+                        scans.add(table)
+        return scans
+
+    def login(self, user_id):
+        with self.client.session_transaction() as session:
+            session['user_id'] = user_id
+
+    def test_detail_pages_use_indexes(self):
+        """Test that detail pages find links and comments by index"""
+        for url in ('/characters/1', '/films/1', '/starships/12', '/vehicles/14', '/species/1', '/planets/1'):
+            statements = self.record(lambda: self.client.get(url))
+            self.assertTrue(any('comments' in statement for statement, _ in statements), url)
+            self.assertEqual(self.full_scans(statements), set(), url)
+
+    def test_profile_uses_indexes(self):
+        """Test that the profile finds a user's comments by index"""
+        self.login(self.author_id)
+        statements = self.record(lambda: self.client.get(f'/profile/{self.author_id}'))
+        self.assertEqual(self.full_scans(statements), set())
+
+    def test_vote_uses_indexes(self):
+        """Test that a vote finds the voter's earlier vote by index"""
+        self.login(self.voter_id)
+        statements = self.record(lambda: self.client.post('/comment/1/vote', data={'vote': 'up'},
+                                                          headers={'Referer': '/characters/1'}))
+        self.assertTrue(any('comment_votes' in statement for statement, _ in statements))
+        self.assertEqual(self.full_scans(statements), set())
+
+    def test_list_pages_seek_by_index(self):
+        """Test that list pages after a cursor seek into an index instead of
+        scanning, both among rows with a sort value and among those without"""
+        values = {str: 'M', int: 1, float: 1.0, date: date(1977, 5, 25)}
+        for model, sorts in LIST_SORTS.items():
+            for sort, column in sorts.items():
+                for value in (values[column.type.python_type], None):
+                    for order in ('asc', 'desc'):
+                        after = encode_cursor(value, 1)
+                        statements = self.record(lambda: keyset_page(model, sort, order, after))
+                        for plan in self.plans(statements):
+                            steps = ' / '.join(plan)
+                            self.assertRegex(steps, r'SEARCH|Index Cond', (sort, value, order))
+                            self.assertNotRegex(steps, r'\bSCAN\b|Seq Scan|TEMP B-TREE|Sort', (sort, value, order))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,264 @@
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from app import app, db
+from models import User, Comment, CommentVote, CommentVoteChange, Person
+from votes import cast_vote, insert_vote_statement, record_vote, reconcile_votes, VoteBuffer, vote_buffer
+
+
+class VoteTestCase(unittest.TestCase):
+    def setUp(self):
+        """Add a comment on Luke by one user and three voters"""
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            luke = Person(id=1, name='Luke Skywalker')
+            users = [User(username=f'user{i}', email=f'user{i}@example.com', password='x') for i in range(4)]
+            db.session.add_all([luke] + users)
+            db.session.flush()
+            comment = Comment.about(luke, text='Nice', user=users[0])
+            db.session.add(comment)
+            db.session.commit()
+            self.comment_id = comment.id
+            self.author_id, *self.voter_ids = [user.id for user in users]
+
+    def tearDown(self):
+        """Remove session and drop all tables"""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def counters(self):
+        comment = db.session.get(Comment, self.comment_id)
+        db.session.refresh(comment)
+        return comment.upvotes, comment.downvotes
+
+    def ledger(self):
+        votes = CommentVote.query.filter_by(comment_id=self.comment_id).all()
+        return sum(vote.vote for vote in votes), sum(not vote.vote for vote in votes)
+
+
+class VoteTests(VoteTestCase):
+    def test_vote_take_back_and_flip(self):
+        """Test that voting again takes a vote back and voting the other way flips it"""
+        voter = self.voter_ids[0]
+        with app.app_context():
+            self.assertEqual(cast_vote(self.comment_id, voter, True), (1, 0))
+            self.assertEqual(cast_vote(self.comment_id, voter, False), (-1, 1))
+            self.assertEqual(cast_vote(self.comment_id, voter, False), (0, -1))
+            db.session.commit()
+
+            self.assertEqual(self.counters(), (0, 0))
+            self.assertEqual(CommentVote.query.count(), 0)
+
+    def test_counters_follow_ledger(self):
+        """Test that the counters match the vote rows after mixed votes"""
+        with app.app_context():
+            for voter, up in [(0, True), (1, True), (2, False), (1, False), (0, True), (2, True)]:
+                cast_vote(self.comment_id, self.voter_ids[voter], up)
+            db.session.commit()
+
+            self.assertEqual(self.counters(), (1, 1))
+            self.assertEqual(self.ledger(), (1, 1))
+
+    def test_duplicate_vote_is_ignored(self):
+        """Test that a second insert of a vote, as made by a racing request, adds nothing"""
+        voter = self.voter_ids[0]
+        with app.app_context():
+            cast_vote(self.comment_id, voter, True)
+            inserted = db.session.execute(insert_vote_statement().values(
+                comment_id=self.comment_id, user_id=voter, vote=True)).rowcount
+            db.session.commit()
+
+            self.assertEqual(inserted, 0)
+            self.assertEqual(CommentVote.query.count(), 1)
+            self.assertEqual(self.counters(), (1, 0))
+
+    def test_vote_route_writes_without_reading_votes(self):
+        """Test that the route never reads counters or votes back to write them"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.client.session_transaction() as session:
+            session['user_id'] = self.voter_ids[0]
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                self.client.post(f'/comment/{self.comment_id}/vote', data={'vote': 'down'},
+                                 headers={'Referer': '/characters/1'})
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            self.assertEqual(self.counters(), (0, 1))
+
+        self.assertFalse(any(s.lstrip().startswith('SELECT') and 'comment_votes' in s for s in statements))
+        self.assertTrue(any('upvotes=(comments.upvotes +' in s.replace(' = ', '=') for s in statements))
+
+
+class VoteBufferTests(VoteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 0.0
+        self.buffer = VoteBuffer(clock=lambda: self.now)
+
+    def vote(self, voter, direction):
+        with self.client.session_transaction() as session:
+            session['user_id'] = voter
+        self.client.post(f'/comment/{self.comment_id}/vote', data={'vote': direction},
+                         headers={'Referer': '/characters/1'})
+
+    def test_deltas_are_summed_per_comment(self):
+        """Test that buffered votes reach the counters in one write per comment"""
+        self.buffer.add(self.comment_id, (1, 0))
+        self.buffer.add(self.comment_id, (1, 0))
+        self.buffer.add(self.comment_id, (-1, 1))
+        self.buffer.add(self.comment_id, (0, 0))
+
+        with app.app_context():
+            self.assertEqual(self.buffer.flush(), 1)
+            self.assertEqual(self.counters(), (1, 1))
+            self.assertEqual(self.buffer.flush(), 0)
+
+        stats = self.buffer.stats()
+        self.assertEqual((stats['flushes'], stats['votes'], stats['rows']), (1, 3, 1))
+        self.assertEqual((stats['pending_votes'], stats['pending_rows'], stats['max_rows']), (0, 0, 1))
+
+    def test_failed_flush_keeps_deltas(self):
+        """Test that deltas survive a flush that fails"""
+        self.buffer.add(self.comment_id, (1, 0))
+        with app.app_context():
+            db.drop_all()
+            with self.assertRaises(Exception):
+                self.buffer.flush()
+            self.assertEqual(self.buffer.stats()['failures'], 1)
+            db.create_all()
+
+        self.assertEqual(self.buffer.pending, {self.comment_id: (1, 0)})
+
+    def test_write_behind_route(self):
+        """Test that in write-behind mode the ledger is written at once and the counters on flush"""
+        app.config['VOTE_WRITE_BEHIND'] = True
+        try:
+            for voter in self.voter_ids:
+                self.vote(voter, 'up')
+
+            with app.app_context():
+                self.assertEqual(self.ledger(), (3, 0))
+                self.assertEqual(self.counters(), (0, 0))
+                self.assertEqual(self.client.get('/votes/stats').get_json()['buffer']['pending_votes'], 3)
+
+                vote_buffer.flush()
+                self.assertEqual(self.counters(), (3, 0))
+        finally:
+            app.config['VOTE_WRITE_BEHIND'] = False
+            vote_buffer.pending.clear()
+
+
+class ReconcileTests(VoteTestCase):
+    def setUp(self):
+        """Add a second comment and votes on both"""
+        super().setUp()
+        with app.app_context():
+            other = Comment.about(db.session.get(Person, 1), text='Meh', user_id=self.author_id)
+            db.session.add(other)
+            db.session.commit()
+            self.other_id = other.id
+            for voter in self.voter_ids:
+                cast_vote(self.comment_id, voter, True)
+                cast_vote(self.other_id, voter, False)
+            db.session.commit()
+            self.settle()
+
+    def settle(self):
+        """Age the vote change log past the settle time"""
+        CommentVoteChange.query.update({'changed_at': datetime.utcnow() - timedelta(hours=1)})
+        db.session.commit()
+
+    def set_counters(self, comment_id, upvotes, downvotes):
+        """Move the counters behind the ledger's back"""
+        Comment.query.filter_by(id=comment_id).update({'upvotes': upvotes, 'downvotes': downvotes})
+        db.session.commit()
+
+    def test_full_reconcile_repairs_drift(self):
+        """Test that a full run finds and repairs drift with a fixed number of queries"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            self.set_counters(self.comment_id, 7, 2)
+            self.set_counters(self.other_id, 0, 0)
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                drift = reconcile_votes(full=True)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            self.assertEqual(drift, [(self.comment_id, -4, -2), (self.other_id, 0, 3)])
+            self.assertEqual(self.counters(), (3, 0))
+            self.assertEqual(reconcile_votes(full=True), [])
+
+        self.assertEqual(len([s for s in statements if s.lstrip().startswith('SELECT')]), 2)
+
+    def test_incremental_reconcile_checks_changed_comments(self):
+        """Test that an incremental run only checks comments voted on since the last run"""
+        with app.app_context():
+            reconcile_votes()
+            self.assertEqual(CommentVoteChange.query.count(), 0)
+
+            self.set_counters(self.comment_id, 7, 0)
+            self.set_counters(self.other_id, 9, 9)
+            cast_vote(self.other_id, self.voter_ids[0], False)
+            db.session.commit()
+            self.settle()
+
+            self.assertEqual(reconcile_votes(), [(self.other_id, -9, -6)])
+            self.assertEqual(self.counters(), (7, 0))
+            self.assertEqual(reconcile_votes(), [])
+
+    def test_reconcile_skips_buffered_votes(self):
+        """Test that comments voted on within the settle time are left alone
+        until their buffered deltas are flushed"""
+        with app.app_context():
+            reconcile_votes()
+            buffer = VoteBuffer()
+            buffer.add(self.comment_id, record_vote(self.comment_id, self.voter_ids[0], True))
+            db.session.commit()
+
+            for full in (False, True):
+                self.assertEqual(reconcile_votes(full=full), [])
+            self.assertEqual(self.counters(), (3, 0))
+            self.assertEqual(CommentVoteChange.query.count(), 1)
+
+            buffer.flush()
+            self.settle()
+            self.assertEqual(reconcile_votes(), [])
+            self.assertEqual(self.counters(), (2, 0))
+            self.assertEqual(CommentVoteChange.query.count(), 0)
+
+    def test_dry_run_reports_only(self):
+        """Test that a dry run leaves the counters and the change log alone"""
+        with app.app_context():
+            self.set_counters(self.comment_id, 0, 0)
+            self.assertEqual(reconcile_votes(repair=False), [(self.comment_id, 3, 0)])
+            self.assertEqual(self.counters(), (0, 0))
+            self.assertEqual(CommentVoteChange.query.count(), 6)
+
+    def test_reconcile_command(self):
+        """Test the flask votes reconcile command"""
+        with app.app_context():
+            self.set_counters(self.comment_id, 1, 1)
+
+        result = app.test_cli_runner().invoke(args=['votes', 'reconcile', '--full'])
+        self.assertIn(f'comment {self.comment_id}: upvotes +2, downvotes -1', result.output)
+        self.assertIn('Repaired drift on 1 comments', result.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
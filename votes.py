@@ -0,0 +1,246 @@
+"""Comment votes.
+
+comment_votes is the ledger: at most one row per comment and user, kept
+unique by uq_comment_votes_comment_id_user_id.  The upvotes and downvotes
+counters on comments follow it by deltas applied in SQL, never by writing
+back values read into Python, so concurrent votes cannot lose updates.
+
+In write-behind mode the counter deltas are summed in a VoteBuffer and
+written in batches, so a burst of votes on one comment takes its row lock
+once per flush instead of once per vote.
+
+Every vote that changes the ledger also logs its comment in
+comment_vote_changes, so reconcile_votes() can recheck just the comments
+voted on since its last run.  Comments voted on in the last SETTLE_TIME
+seconds are left for a later run, as their deltas may still be buffered."""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Comment, CommentVote, CommentVoteChange
+
+# Seconds between flushes of the write-behind vote buffer
+FLUSH_INTERVAL = float(os.environ.get('VOTE_FLUSH_INTERVAL', 1))
+
+# Seconds since its last vote before reconcile_votes() checks a comment; a
+# few flushes, so no delta of it is still waiting in a VoteBuffer
+SETTLE_TIME = float(os.environ.get('VOTE_SETTLE_TIME', 5 * FLUSH_INTERVAL))
+
+
+def insert_vote_statement():
+    """INSERT ... ON CONFLICT (comment_id, user_id) DO NOTHING into comment_votes"""
+    dialects = {'postgresql': postgresql, 'sqlite': sqlite}
+    dialect = dialects.get(db.engine.dialect.name)
+    if dialect is None:
+        raise RuntimeError(f'Upserts are not supported on {db.engine.dialect.name}')
+
+    return dialect.insert(CommentVote.__table__).on_conflict_do_nothing(index_elements=['comment_id', 'user_id'])
+
+
+def record_vote(comment_id, user_id, up):
+    """Record a user's up or down vote on a comment in the ledger and return
+    the (upvotes, downvotes) delta it makes to the comment's counters.
+
+    Voting the same way again takes the vote back and voting the other way
+    flips it.  Each step is a single statement whose row count says what it
+    changed, so two requests racing on the same vote move the counters by
+    exactly what reached the ledger.  Runs in the caller's transaction."""
+    votes = CommentVote.__table__
+    same_vote = (votes.c.comment_id == comment_id) & (votes.c.user_id == user_id)
+
+    if db.session.execute(votes.delete().where(same_vote, votes.c.vote == up)).rowcount:
+        delta = (-1, 0) if up else (0, -1)
+    elif db.session.execute(votes.update().where(same_vote, votes.c.vote != up).values(vote=up)).rowcount:
+        delta = (1, -1) if up else (-1, 1)
+    elif db.session.execute(insert_vote_statement().values(comment_id=comment_id, user_id=user_id,
+                                                           vote=up)).rowcount:
+        delta = (1, 0) if up else (0, 1)
+    else:
+        delta = (0, 0)
+
+    if delta != (0, 0):
+        db.session.execute(CommentVoteChange.__table__.insert().values(comment_id=comment_id))
+    return delta
+
+
+def cast_vote(comment_id, user_id, up):
+    """record_vote() and move the comment's counters in the same transaction"""
+    delta = record_vote(comment_id, user_id, up)
+    apply_vote_deltas({comment_id: delta})
+    return delta
+
+
+def apply_vote_deltas(deltas, connection=None):
+    """Add {comment id: (upvotes, downvotes)} deltas to the comment counters,
+    on `connection` or else in the session's transaction"""
+    rows = [{'comment_id': id, 'up': up, 'down': down} for id, (up, down) in deltas.items() if up or down]
+    if not rows:
+        return
+
+    comments = Comment.__table__
+    (connection or db.session).execute(
+        comments.update()
+        .where(comments.c.id == bindparam('comment_id'))
+        .values(upvotes=comments.c.upvotes + bindparam('up'), downvotes=comments.c.downvotes + bindparam('down')),
+        rows
+    )
+
+
+def vote_drift(comment_ids=None):
+    """[(comment id, upvotes drift, downvotes drift)] of every comment whose
+    counters differ from its votes in the ledger, limited to `comment_ids`
+    (a list or a select of ids) if given.  One aggregate query."""
+    votes = CommentVote.__table__
+    tally = db.select(
+        votes.c.comment_id,
+        db.func.sum(db.case((votes.c.vote, 1), else_=0)).label('up'),
+        db.func.sum(db.case((votes.c.vote, 0), else_=1)).label('down'),
+    ).group_by(votes.c.comment_id)
+    if comment_ids is not None:
+        tally = tally.where(votes.c.comment_id.in_(comment_ids))
+    tally = tally.subquery()
+
+    up = db.func.coalesce(tally.c.up, 0) - db.func.coalesce(Comment.upvotes, 0)
+    down = db.func.coalesce(tally.c.down, 0) - db.func.coalesce(Comment.downvotes, 0)
+    query = (db.select(Comment.id, up, down)
+             .outerjoin(tally, tally.c.comment_id == Comment.id)
+             .where((up != 0) | (down != 0))
+             .order_by(Comment.id))
+    if comment_ids is not None:
+        query = query.where(Comment.id.in_(comment_ids))
+    return db.session.execute(query).all()
+
+
+def reconcile_votes(full=False, repair=True, settle=SETTLE_TIME):
+    """Recompute comment counters from the ledger and return the drift found.
+
+    Only comments logged in comment_vote_changes are checked, unless `full`.
+    Drift is repaired as deltas, so votes cast while this runs are neither
+    lost nor counted twice, and the log is emptied up to where it was read.
+    Comments voted on in the last `settle` seconds are skipped and keep
+    their log rows: deltas of theirs may still be waiting in a worker's
+    VoteBuffer, and would be counted twice if repaired as drift."""
+    changes = CommentVoteChange.__table__
+    last_change = db.session.execute(db.select(db.func.max(changes.c.id))).scalar()
+    unsettled = db.select(changes.c.comment_id).where(
+        changes.c.changed_at > datetime.utcnow() - timedelta(seconds=settle))
+
+    if full:
+        checked = db.select(Comment.id).where(Comment.id.not_in(unsettled))
+    else:
+        checked = db.select(changes.c.comment_id).where(
+            changes.c.id <= (last_change or 0), changes.c.comment_id.not_in(unsettled)).distinct()
+    drift = vote_drift(checked)
+
+    if repair:
+        apply_vote_deltas({id: (up, down) for id, up, down in drift})
+        if last_change is not None:
+            db.session.execute(changes.delete().where(changes.c.id <= last_change,
+                                                      changes.c.comment_id.not_in(unsettled)))
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return drift
+
+
+class VoteBuffer:
+    """Write-behind buffer of comment counter deltas.
+
+    Votes are recorded in the ledger at once; their counter deltas are
+    summed here per comment and written by flush(), one UPDATE per comment
+    with pending votes.  Deltas still buffered when a worker dies are lost
+    from the counters but not from the ledger, and reconcile_votes() puts
+    them back.  `counters` counts flushes, the votes and comments they
+    wrote, failures and flush time in seconds."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.pending = {}
+        self.votes = 0
+        self.lock = threading.Lock()
+        self.counters = {'flushes': 0, 'votes': 0, 'rows': 0, 'failures': 0, 'seconds': 0.0,
+                         'last_rows': 0, 'max_rows': 0, 'last_seconds': 0.0, 'max_seconds': 0.0}
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def add(self, comment_id, delta):
+        """Buffer the delta of a committed vote"""
+        if delta == (0, 0):
+            return
+        with self.lock:
+            up, down = self.pending.get(comment_id, (0, 0))
+            self.pending[comment_id] = (up + delta[0], down + delta[1])
+            self.votes += 1
+
+    def flush(self):
+        """Write the buffered deltas in their own transaction; returns the
+        number of comments written.  On failure the deltas are kept for the
+        next flush."""
+        with self.lock:
+            pending, votes = self.pending, self.votes
+            self.pending, self.votes = {}, 0
+        if not pending:
+            return 0
+
+        start = self.clock()
+        try:
+            with db.engine.begin() as connection:
+                apply_vote_deltas(pending, connection)
+        except Exception:
+            with self.lock:
+                for comment_id, (up, down) in pending.items():
+                    pending_up, pending_down = self.pending.get(comment_id, (0, 0))
+                    self.pending[comment_id] = (pending_up + up, pending_down + down)
+                self.votes += votes
+                self.counters['failures'] += 1
+            raise
+
+        seconds = self.clock() - start
+        with self.lock:
+            counters = self.counters
+            counters['flushes'] += 1
+            counters['votes'] += votes
+            counters['rows'] += len(pending)
+            counters['seconds'] += seconds
+            counters['last_rows'], counters['last_seconds'] = len(pending), seconds
+            counters['max_rows'] = max(counters['max_rows'], len(pending))
+            counters['max_seconds'] = max(counters['max_seconds'], seconds)
+        return len(pending)
+
+    def start(self, app, interval=FLUSH_INTERVAL):
+        """Flush every `interval` seconds from a background thread"""
+        if self.thread is not None:
+            return
+
+        def run():
+            while not self.stopped.wait(interval):
+                with app.app_context():
+                    try:
+                        self.flush()
+                    except Exception:
+                        app.logger.exception('Vote buffer flush failed')
+            with app.app_context():
+                self.flush()
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=run, name='vote-buffer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread after a last flush"""
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending_votes=self.votes, pending_rows=len(self.pending))
+
+
+vote_buffer = VoteBuffer()